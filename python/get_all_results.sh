@@ -36,6 +36,11 @@
 # python3 hpatches_eval.py --descr-dir=../data/descriptors/ --descr-name=spheredesc-liberty --split=full --task=matching  --task=retrieval  --task=verification
 # python3 hpatches_eval.py --descr-dir=../data/descriptors/ --descr-name=tfeat-liberty --split=full --task=matching  --task=retrieval  --task=verification
 
+# the same descriptors and splits in a single
+# process that reads the task files once (sift and rootsift use ";")
+# python3 hpatches_eval.py --descr-dir=../data/descriptors/ --descr-name=binboost --descr-name=BinGAN128b --descr-name=BinGAN128f --descr-name=brief --descr-name=deepdesc-ubc --descr-name=geodesc --descr-name='hardnet-liberty*' --descr-name='HRankSIFT*' --descr-name='l2net-*' --descr-name=orb --descr-name='spheredesc-*' --descr-name=tfeat-liberty --split=a --split=full --task=matching  --task=retrieval  --task=verification
+# python3 hpatches_eval.py --descr-dir=../data/descriptors/ --descr-name=rootsift --descr-name=sift --split=a --split=full --task=matching  --task=retrieval  --task=verification --delimiter=";"
+
 python3 hpatches_results.py --results-dir=results/ --descr=sift --descr=deepdesc-ubc --descr=tfeat-liberty --descr=SphereDesc_LIB+ --descr=spheredesc-hpatches --descr=hardnet-liberty --descr=geodesc --split=full
 
 # python3 hpatches_results.py --results-dir=results/ --descr=sift --descr=BinGAN128b --descr=BinGAN128f --descr=brief --descr=HRankSIFTB_LB --descr=HRankSIFT_LB --descr=LearnedSIFT --descr=NCC --descr=orb --descr=VGG --split=full
@@ -3,42 +3,135 @@
 Usage:
   hpatches_eval.py (-h | --help)
   hpatches_eval.py --version
-  hpatches_eval.py --descr-name=<> --task=<>... [--descr-dir=<>]
-                   [--results-dir=<>] [--split=<>] [--dist=<>]
-                   [--delimiter=<>] [--pcapl=<>]
+  hpatches_eval.py --descr-name=<>... --task=<>... [--descr-dir=<>]
+                   [--results-dir=<>] [--split=<>...] [--dist=<>]
+                   [--delimiter=<>] [--no-store] [--mem-budget=<>]
+                   [--n-jobs=<>] [--cache=<>] [--prefetch=<>]
+                   [--kernel=<>] [--stream]
 
 Options:
   -h --help         Show this screen.
   --version         Show version.
-  --descr-name=<>   Descriptor name, e.g. sift
+  --descr-name=<>   Descriptor name, e.g. sift, or a glob pattern of
+                        descriptor names, e.g. 'hardnet*'. Can be
+                        repeated to evaluate several descriptors.
   --descr-dir=<>    Descriptor results root folder.
                         [default: {root}/data/descriptors]
   --results-dir=<>  Results root folder.
                         [default: results]
   --task=<>         Task name.
                         Choose from {verification, matching, retrieval}.
-  --split=<>        Split name.
+  --split=<>        Split name, can be repeated.
                         Choose from {a, b, c, full, illum, view}. [default: a]
   --dist=<>         Distance name.
-                        Valid are {L1,L2}. [default: L2]
+                        Valid are {L1,L2,HAMMING}. [default: L2]
+                        HAMMING expects binary descriptors packed
+                        in bytes, one byte per .csv column.
   --delimiter=<>    Delimiter used in the csv files.
                         [default: ,]
+  --no-store        Parse the .csv files instead of using the binary
+                        descriptor store.
+  --mem-budget=<>   Memory budget in MB for the blocks of the
+                        retrieval distance matrix, and for the
+                        verification scores with --stream.
+                        [default: 1024]
+  --n-jobs=<>       Number of worker processes, negative values
+                        count back from the number of CPUs.
+                        [default: -2]
+  --cache=<>        What to do with the results that are already there.
+                        Valid are {skip,force,auto,off}. skip keeps them,
+                        force recomputes them, and auto recomputes only
+                        what depends on the descriptors or task files
+                        that changed since. off recomputes them, and
+                        keeps no intermediate results for auto.
+                        [default: auto]
+  --prefetch=<>     Number of descriptors loaded in the background
+                        ahead of the one being evaluated. [default: 1]
+  --kernel=<>       Distance kernel of the matching and retrieval tasks.
+                        Valid are {exact,blas}. exact computes the
+                        distances as OpenCV and scipy, blas in single
+                        precision with matrix products. By default,
+                        both are exact.
+  --stream          Score the verification pairs as their distances
+                        are computed, without keeping them, for task
+                        files too large for memory. The distances are
+                        then not cached.
 
 For more visit: https://github.com/hpatches/
 """
 from utils.hpatch import load_descrs
-from utils.tasks import tskdir, methods
+from utils.tasks import tskdir, methods, kernels, task_seqs
 from utils.misc import blue
 from utils.docopt import docopt
 import os
-import dill
+import fnmatch
 import json
-from builtins import input
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 
-def do_run_method(t, descr, splt, res_path):
-    res = methods[t](descr, splt)
-    dill.dump(res, open(res_path, "wb"))
+def load_cache(cache_path):
+    """Intermediate results of a previous evaluation, if any"""
+    if not os.path.exists(cache_path):
+        return {}
+    with np.load(cache_path) as f:
+        return dict((k, f[k]) for k in f.files)
+
+
+def do_run_method(t, descr, splt, res_path, task_opts, cache_path, cache,
+                  keep_cache=True):
+    res = methods[t](descr, splt, cache=cache, **task_opts.get(t, {}))
+    np.savez(res_path, **res)
+    if not keep_cache:
+        # the intermediate results kept for the previous results are stale
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        return
+    if not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    np.savez(cache_path, **cache)
+
+
+def find_descrs(descr_dir, patterns):
+    """Descriptor folders of `descr_dir` matching any of the patterns"""
+    descrs = sorted(d for d in os.listdir(descr_dir)
+                    if not d.startswith('.') and
+                    os.path.isdir(os.path.join(descr_dir, d)))
+    names = []
+    for pattern in patterns:
+        matches = fnmatch.filter(descrs, pattern)
+        if not matches:
+            print("{} does not exist.".format(
+                os.path.join(descr_dir, pattern)))
+        names += [m for m in matches if m not in names]
+    return names
+
+
+def eval_descr(descr_name, descr, splts, opts, task_opts):
+    """Runs all the tasks on all the splits for a descriptor"""
+    results_dir = opts['--results-dir']
+    for splt in splts:
+        for t in opts['--task']:
+            res_base = os.path.join(
+                results_dir, descr_name + "_" + t + "_" + splt['name'])
+            res_path = res_base + ".npz"
+            # intermediate results, kept in a hidden folder so that they
+            # are not taken for result files
+            cache_path = os.path.join(
+                results_dir, ".cache", os.path.basename(res_base) + ".npz")
+            # results of older versions are dill pickles
+            cached = os.path.exists(res_path) or \
+                os.path.exists(res_base + ".p")
+            if cached and opts['--cache'] == 'skip':
+                print("Results for the %s, %s task, split %s, already cached!"
+                      % (descr_name, t, splt['name']))
+                continue
+
+            cache = {}
+            if opts['--cache'] == 'auto' and os.path.exists(res_path):
+                cache = load_cache(cache_path)
+            do_run_method(t, descr, splt, res_path, task_opts, cache_path,
+                          cache, keep_cache=opts['--cache'] != 'off')
 
 
 if __name__ == '__main__':
@@ -46,39 +139,68 @@ if __name__ == '__main__':
     descr_dir = opts['--descr-dir'].format(
         root=os.path.normpath(
             os.path.join(os.path.abspath(os.path.dirname(__file__)), "..")))
-    path = os.path.join(descr_dir, opts['--descr-name'])
 
     try:
-        assert os.path.exists(path)
+        assert os.path.exists(descr_dir)
     except Exception:
-        print("{} does not exist.".format(path))
+        print("{} does not exist.".format(descr_dir))
+        exit(0)
+
+    descr_names = find_descrs(descr_dir, opts['--descr-name'])
+    if not descr_names:
+        exit(0)
+
+    if opts['--cache'] not in ['skip', 'force', 'auto', 'off']:
+        print("Unknown cache policy %s - valid options are "
+              "|skip|force|auto|off|" % opts['--cache'])
+        exit(0)
+
+    if opts['--kernel'] is not None and opts['--kernel'] not in kernels:
+        print("Unknown kernel %s - valid options are |exact|blas|"
+              % opts['--kernel'])
         exit(0)
 
     results_dir = opts['--results-dir']
     if not os.path.exists(results_dir):
         os.makedirs(results_dir)
 
-    descr_name = opts['--descr-name']
-    print('\n>> Running HPatch evaluation for %s' % blue(descr_name))
-
-    descr = load_descrs(path, dist=opts['--dist'], sep=opts['--delimiter'])
-
     with open(os.path.join(tskdir, "splits", "splits.json")) as f:
         splits = json.load(f)
 
-    splt = splits[opts['--split']]
-
-    for t in opts['--task']:
-        res_path = os.path.join(
-            results_dir, descr_name + "_" + t + "_" + splt['name'] + ".p")
-        if os.path.exists(res_path):
-            print("Results for the %s, %s task, split %s, already cached!" %
-                  (descr_name, t, splt['name']))
-            ans = input('Do you want to re-run this? (yes)/(no): ')
-            if ans.lower() == 'yes':
-                do_run_method(t, descr, splt, res_path)
-            else:
-                pass
-
-        else:
-            do_run_method(t, descr, splt, res_path)
+    splts = [splits[s] for s in opts['--split']]
+
+    task_opts = {
+        'verification': {'stream': opts['--stream'],
+                         'mem_budget': float(opts['--mem-budget']) * 2 ** 20},
+        'matching': {'n_jobs': int(opts['--n-jobs']),
+                     'kernel': opts['--kernel']},
+        'retrieval': {'mem_budget': float(opts['--mem-budget']) * 2 ** 20,
+                      'n_jobs': int(opts['--n-jobs']),
+                      'kernel': opts['--kernel']}}
+
+    # only the sequences the tasks read on the splits are loaded
+    seqs = task_seqs(splts, opts['--task'])
+
+    # the descriptors are parsed by as many workers as the tasks use, as
+    # the loads in the background share the pool of worker processes of
+    # the tasks, which can not be resized while they use it
+    def load(descr_name):
+        return load_descrs(os.path.join(descr_dir, descr_name),
+                           dist=opts['--dist'], sep=opts['--delimiter'],
+                           store=not opts['--no-store'], seqs=seqs,
+                           n_jobs=int(opts['--n-jobs']))
+
+    # the descriptors are loaded by a background thread, at most
+    # `--prefetch` of them ahead of the one being evaluated, while the
+    # task files are read once and shared by all of them
+    n_prefetch = int(opts['--prefetch'])
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        loads = []
+        for i, descr_name in enumerate(descr_names):
+            while len(loads) < min(i + n_prefetch + 1, len(descr_names)):
+                loads.append(pool.submit(load, descr_names[len(loads)]))
+            descr = loads[i].result()
+            loads[i] = None
+            print('\n>> Running HPatch evaluation for %s' % blue(descr_name))
+            eval_descr(descr_name, descr, splts, opts, task_opts)
+            del descr
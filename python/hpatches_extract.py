@@ -0,0 +1,56 @@
+"""Descriptor extraction for the HPatches homography patches dataset.
+
+Usage:
+  hpatches_extract.py (-h | --help)
+  hpatches_extract.py --version
+  hpatches_extract.py --descr=<> [--descr-name=<>] [--data-dir=<>]
+                      [--descr-dir=<>] [--batch-size=<>] [--n-jobs=<>]
+
+Options:
+  -h --help         Show this screen.
+  --version         Show version.
+  --descr=<>        Descriptor function.
+                        Choose from {meanstd, sift, rootsift, orb}, or
+                        give a function as module:function, which takes
+                        a (patches, 65, 65) uint8 array and returns a
+                        (patches, dim) array of descriptors, uint8 for
+                        binary descriptors packed in bytes.
+  --descr-name=<>   Name of the descriptor folder. Defaults to the
+                        descriptor function name.
+  --data-dir=<>     HPatches release folder.
+                        [default: {root}/data/hpatches-release]
+  --descr-dir=<>    Descriptor results root folder.
+                        [default: {root}/data/descriptors]
+  --batch-size=<>   Number of patches described at once. [default: 4096]
+  --n-jobs=<>       Number of worker processes, negative values
+                        count back from the number of CPUs.
+                        [default: -2]
+
+For more visit: https://github.com/hpatches/
+"""
+from utils.extract import descr_function, extract_descrs
+from utils.misc import blue
+from utils.docopt import docopt
+import os
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__, version='HPatches 1.0')
+    root = os.path.normpath(
+        os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+    data_dir = opts['--data-dir'].format(root=root)
+    descr_dir = opts['--descr-dir'].format(root=root)
+
+    try:
+        assert os.path.exists(data_dir)
+    except Exception:
+        print("{} does not exist.".format(data_dir))
+        exit(0)
+
+    descr_fun = descr_function(opts['--descr'])
+    descr_name = opts['--descr-name'] or opts['--descr'].split(':')[-1]
+    print('\n>> Extracting the %s descriptors' % blue(descr_name))
+    extract_descrs(data_dir, os.path.join(descr_dir, descr_name), descr_fun,
+                   batch_size=int(opts['--batch-size']),
+                   n_jobs=int(opts['--n-jobs']))
+    print('>> Descriptors saved to %s' % os.path.join(descr_dir, descr_name))
@@ -3,35 +3,63 @@
 Usage:
   hpatches_results.py (-h | --help)
   hpatches_results.py --version
-  hpatches_results.py --descr-name=<>...
-                      [--results-dir=<>] [--split=<>] [--pcapl=<>]
+  hpatches_results.py [--descr-name=<>...]
+                      [--results-dir=<>] [--split=<>] [--ci=<>]
 
 Options:
   -h --help         Show this screen.
   --version         Show version.
-  --descr-name=<>   Descriptor name e.g. --descr=sift.
+  --descr-name=<>   Descriptor name e.g. --descr=sift. Defaults to all
+                        the known descriptors with results for the
+                        three tasks.
   --results-dir=<>  Results root folder. [default: results]
   --split=<>        Split name. Valid are {a,b,c,full,illum,view}. [default: a]
+  --ci=<>           Number of bootstrap resamples of the 95% confidence
+                        intervals of the scores, printed and drawn as
+                        error bars, 0 for none. [default: 0]
 
 For more visit: https://github.com/hpatches/
 """
 from utils.tasks import tskdir
 from utils.results import plot_hpatches_results
-from utils.results import DescriptorHPatchesResult
+from utils.results import DescriptorHPatchesResult, update_results_index
+from utils.bootstrap import bootstrap_results, print_intervals
+from utils.config import desc_info
 import os.path
 import json
 from utils.docopt import docopt
 
 if __name__ == '__main__':
     opts = docopt(__doc__, version='HPatches 1.0')
-    descrs = opts['--descr-name']
+    results_dir = opts['--results-dir']
 
     with open(os.path.join(tskdir, "splits", "splits.json")) as f:
         splits = json.load(f)
     splt = splits[opts['--split']]
 
+    # the aggregate results of all the result files, updated for the
+    # result files that changed since the last run
+    index = update_results_index(results_dir)
+
+    descrs = opts['--descr-name']
+    if not descrs:
+        tasks = {}
+        for row in index.values():
+            if row['split'] == splt['name']:
+                tasks.setdefault(row['desc'], set()).add(row['task'])
+        descrs = [desc for desc in sorted(tasks)
+                  if len(tasks[desc]) == 3 and desc in desc_info]
+
     hpatches_results = []
     for desc in descrs:
-        hpatches_results.append(DescriptorHPatchesResult(desc, splt))
+        hpatches_results.append(
+            DescriptorHPatchesResult(desc, splt, results_dir, index=index))
+
+    # intervals of the scores and of the differences between descriptors,
+    # from the results and verification distances of the evaluation
+    n_boot = int(opts['--ci'])
+    if n_boot > 0:
+        replicates = bootstrap_results(hpatches_results, results_dir, n_boot)
+        print_intervals(hpatches_results, replicates)
 
     plot_hpatches_results(hpatches_results)
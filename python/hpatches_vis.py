@@ -1,7 +1,7 @@
 import numpy as np
 import cv2
 import os.path
-from utils.hpatch import hpatches_sequence, get_patch
+from utils.hpatch import load_patches, get_patch
 
 # all types of patches
 tps = ['ref', 'e1', 'e3', 'e5', 'h1', 'h3', 'h5', 't1', 't3', 't5']
@@ -37,9 +37,9 @@ tp = tps
 # list of patch indices to visualise
 ids = range(1, 55)
 
-# load a sample sequence
+# load a sample sequence, from the patch store of the release
 seq_name = "v_calder"
-seq = hpatches_sequence(os.path.join(datadir, "hpatches-release", seq_name))
+seq = load_patches(os.path.join(datadir, "hpatches-release"))[seq_name]
 vis = vis_patches(seq, tp, ids)
 
 # show
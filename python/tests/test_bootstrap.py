@@ -0,0 +1,65 @@
+import os.path
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import utils.bootstrap as bootstrap  # noqa: E402
+import utils.metrics as metrics  # noqa: E402
+from utils.tasks import tp, verif_scores  # noqa: E402
+
+
+def verif_dists(rng, n):
+    # single precision distances of the positives and of each negatives,
+    # by noise level, some of them tied
+    return [np.round(rng.normal(mu, 0.3, (n, len(tp))), 3).astype(np.float32)
+            for mu in (0.6, 0.9, 1.1)]
+
+
+def test_unit_weights(monkeypatch):
+    # resamples that draw every block once are the exact scores
+    def unit_weights(rng, n, n_boot, n_blocks=bootstrap.VERIF_BLOCKS):
+        W, blocks = block_weights(rng, n, n_boot, n_blocks)
+        return np.ones_like(W), blocks
+    block_weights = bootstrap.block_weights
+    monkeypatch.setattr(bootstrap, 'block_weights', unit_weights)
+
+    rng = np.random.default_rng(0)
+    d_pos, d_intra, d_inter = verif_dists(rng, 5000)
+    reps = bootstrap.verif_replicates(
+        {'pos_dists': d_pos, 'neg_intra_dists': d_intra,
+         'neg_inter_dists': d_inter}, 3)
+    scores = verif_scores(*[dict((t, d[:, j]) for j, t in enumerate(tp))
+                            for d in (d_pos, d_intra, d_inter)])
+    assert np.allclose(reps['avg_balanced'], 100 * scores[:, 0, 0].mean(),
+                       rtol=0, atol=1e-9)
+    assert np.allclose(reps['avg_imbalanced'], 100 * scores[:, :, 1].mean(),
+                       rtol=0, atol=1e-9)
+
+
+def test_grouped_metrics():
+    # the grouped metrics of resamples are within 1e-4 of the exact ones,
+    # computed on the pairs repeated as many times as their block is drawn
+    rng = np.random.default_rng(1)
+    n = 20000
+    d_neg, d_pos = [rng.normal(mu, 0.3, n).astype(np.float32)
+                    for mu in (1.0, 0.6)]
+    W_neg, b_neg = bootstrap.block_weights(rng, n, 5)
+    W_pos, b_pos = bootstrap.block_weights(rng, n, 5)
+    r = metrics.merge_rankings(metrics.ranking(-d_neg, 0),
+                               metrics.ranking(-d_pos, 1))
+    Nc, Pc, before = bootstrap.group_counts(r, n, b_neg, b_pos)
+    for grouped, exact, curve in [
+            (bootstrap.grouped_auc, r.auc(), metrics.roc),
+            (bootstrap.grouped_ap, r.ap(), metrics.pr)]:
+        reps = grouped(bootstrap.weighted(W_neg, Nc),
+                       bootstrap.weighted(W_pos, Pc), before) + exact - \
+            grouped(bootstrap.total(Nc), bootstrap.total(Pc), before)
+        for i in range(W_neg.shape[0]):
+            w_neg = W_neg[i][b_neg].astype(int)
+            w_pos = W_pos[i][b_pos].astype(int)
+            scores = np.concatenate((np.repeat(-d_neg, w_neg),
+                                     np.repeat(-d_pos, w_pos)))
+            labels = np.concatenate((np.zeros(w_neg.sum()),
+                                     np.ones(w_pos.sum())))
+            assert abs(reps[i] - curve(scores, labels)[2]) < 1e-4
@@ -0,0 +1,92 @@
+import os.path
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import utils.metrics as metrics  # noqa: E402
+
+
+def tied_scores(rng, shape, levels=10):
+    # few distinct values, so that most scores are tied with others
+    return rng.integers(0, levels, shape).astype(np.float64)
+
+
+def test_pr_at_ranks():
+    rng = np.random.default_rng(0)
+    scores = tied_scores(rng, (50, 40))
+    labels = rng.random((50, 40)) < 0.2
+    # entries never retrieved, after the first one of each row
+    scores[:, 1:][rng.random((50, 39)) < 0.2] = -np.inf
+    ranks = [1, 5, 12, 40]
+    ap = metrics.pr_at_ranks(scores, labels, ranks)
+    for i in range(scores.shape[0]):
+        for j, k in enumerate(ranks):
+            assert np.isclose(ap[i, j], metrics.pr(
+                scores[i, 0:k], labels[i, 0:k])[2], rtol=0, atol=1e-12)
+
+
+def test_ranking():
+    rng = np.random.default_rng(1)
+    scores = tied_scores(rng, 500)
+    labels = rng.random(500) < 0.3
+    scores[1:][rng.random(499) < 0.1] = -np.inf
+    r = metrics.ranking(scores, labels)
+    assert r.ap() == metrics.pr(scores, labels)[2]
+    assert r.auc() == metrics.roc(scores, labels)[2]
+    assert r.ap(400) == metrics.pr(scores, labels, 400)[2]
+    for k in [1, 77, 250, 500]:
+        assert r.prefix(k).ap() == metrics.pr(scores[:k], labels[:k])[2]
+        assert r.prefix(k).auc() == metrics.roc(scores[:k], labels[:k])[2]
+
+
+def test_merge_rankings():
+    rng = np.random.default_rng(2)
+    # negatives then positives, as in the verification task, and parts of
+    # mixed labels, with scores tied within and across the two parts
+    for labels_a, labels_b in [(np.zeros(300), np.ones(200)),
+                               (rng.random(300) < 0.5, rng.random(200) < 0.5)]:
+        sa, sb = tied_scores(rng, 300), tied_scores(rng, 200)
+        r = metrics.merge_rankings(metrics.ranking(sa, labels_a),
+                                   metrics.ranking(sb, labels_b))
+        scores = np.concatenate((sa, sb))
+        labels = np.concatenate((labels_a, labels_b))
+        assert r.ap() == metrics.pr(scores, labels)[2]
+        assert r.auc() == metrics.roc(scores, labels)[2]
+        assert r.prefix(400).ap() == metrics.pr(scores[:400],
+                                                labels[:400])[2]
+
+
+def exact(neg, pos):
+    # AUC and AP of negatives and positives, the negatives first in the
+    # scores, so that they are ranked first among ties
+    scores = np.concatenate((neg, pos))
+    labels = np.concatenate((np.zeros(len(neg)), np.ones(len(pos))))
+    return metrics.roc(scores, labels)[2], metrics.pr(scores, labels)[2]
+
+
+def test_score_histogram():
+    rng = np.random.default_rng(3)
+    # minus the Hamming distances of 256 bit descriptors, and real scores
+    # with heavy ties, some of them out of the range of the bins
+    hamming = [-rng.binomial(256, 0.3, 5000).astype(np.float64),
+               -rng.binomial(256, 0.2, 1000).astype(np.float64)]
+    real = [np.round(rng.normal(0, 1, 5000), 1),
+            np.round(rng.normal(1, 1, 1000), 1)]
+    real[1][:10] = -np.inf
+    for (neg, pos), lo, hi, bins in [(hamming, -256, 0, 16),
+                                     (hamming, -256, 1, 257),
+                                     (real, -2, 2, 8),
+                                     (real, -3, 3, 1000)]:
+        auc, ap = exact(neg, pos)
+        h = metrics.score_histogram(lo, hi, bins)
+        for b in range(0, len(neg), 1500):
+            h.add(neg[b:b + 1500], 0)
+        h.add(pos, 1)
+        assert h.auc()[0] <= auc + 1e-12 and auc <= h.auc()[1] + 1e-12
+        assert h.ap()[0] <= ap + 1e-12 and ap <= h.ap()[1] + 1e-12
+        if bins == 257:
+            # a bin per distance, the lower bounds rank the negatives first
+            # among ties, as the exact metrics
+            assert np.isclose(h.auc()[0], auc, rtol=0, atol=1e-12)
+            assert np.isclose(h.ap()[0], ap, rtol=0, atol=1e-12)
@@ -0,0 +1,28 @@
+import os.path
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from utils.tasks import stream_verif_scores, tp, verif_scores  # noqa: E402
+
+
+def chunks(d, size):
+    for start in range(0, len(d['e']), size):
+        yield start, dict((t, d[t][start:start + size]) for t in tp)
+
+
+def test_stream_verif_scores():
+    # integer distances, with many ties between and within the positives
+    # and the negatives
+    rng = np.random.default_rng(0)
+    n = 20000
+    d_pos, d_intra, d_inter = [
+        dict((t, rng.integers(0, 50 + 20 * k, n).astype(np.float64))
+             for t in tp) for k in range(3)]
+    scores = verif_scores(d_pos, d_intra, d_inter)
+    # a budget small enough for the scores to be written in several runs
+    stream = stream_verif_scores(chunks(d_pos, 3000), chunks(d_intra, 3000),
+                                 chunks(d_inter, 3000), n, n, n,
+                                 mem_budget=9 * 2 ** 14)
+    assert np.allclose(stream, scores, rtol=0, atol=1e-12)
@@ -0,0 +1,281 @@
+import os.path
+
+import numpy as np
+import utils.metrics as metrics
+from scipy import sparse
+from utils.misc import blue
+from utils.results import load_results
+
+# confidence level of the intervals
+CI_LEVEL = 0.95
+# seed of the resamples, the same for all the descriptors, so that the
+# replicates of two descriptors are computed on the same resamples and
+# their difference is a paired one
+SEED = 0
+# number of blocks of consecutive pairs resampled in the verification
+# task, and number of groups of the ranking in which their scores are
+# counted, see `verif_replicates`
+VERIF_BLOCKS = 1000
+VERIF_GROUPS = 2048
+
+
+##############
+# Resampling #
+##############
+# A resample of n units is a row of an index matrix of n indices drawn with
+# replacement, and all the replicates of a score are computed from the
+# matrix at once.
+def resample_indices(rng, n, n_boot):
+    """Index matrix of `n_boot` resamples of n units"""
+    return rng.integers(0, n, (n_boot, n))
+
+
+def resample_weights(rng, n, n_boot):
+    """Number of times each of n units is drawn in each of `n_boot`
+    resamples, as a (n_boot, n) matrix"""
+    idx = resample_indices(rng, n, n_boot)
+    idx += n * np.arange(n_boot)[:, None]
+    return np.bincount(idx.ravel(), minlength=n_boot * n).reshape(n_boot, n)
+
+
+def confidence_interval(replicates, level=CI_LEVEL):
+    """Percentile interval of the replicates of a score"""
+    alpha = 100 * (1 - level) / 2.0
+    lo, hi = np.percentile(replicates, [alpha, 100 - alpha])
+    return float(lo), float(hi)
+
+
+#################
+# Matching task #
+#################
+def matching_replicates(res, n_boot, seed=SEED):
+    """Replicates of the matching mAP, resampling the test sequences of
+    each type from the mAPs of the sequences in the results"""
+    seqs, seq_idx = np.unique(res['seq'], return_inverse=True)
+    # mAP of each sequence over its images and noise levels
+    seq_ap = np.zeros(len(seqs))
+    for t in np.unique(res['noise']):
+        m = res['noise'] == t
+        seq_ap += np.bincount(seq_idx[m], res['ap'][m], len(seqs)) / \
+            np.bincount(seq_idx[m], minlength=len(seqs))
+    seq_ap /= len(np.unique(res['noise']))
+    seq_types = np.array([seq.split("_")[0] for seq in seqs])
+
+    rng = np.random.default_rng(seed)
+    avg = 0
+    for seq_type in ['v', 'i']:
+        ap = seq_ap[seq_types == seq_type]
+        avg = avg + ap[resample_indices(rng, len(ap), n_boot)].mean(axis=1)
+    return {'avg': 100 * avg / 2.0}
+
+
+##################
+# Retrieval task #
+##################
+def retrieval_replicates(res, n_boot, seed=SEED):
+    """Replicates of the retrieval mAP, resampling the queries from their
+    APs in the results"""
+    queries, q_idx = np.unique(res['query'], return_inverse=True)
+    # AP of each query over its noise levels and pool sizes
+    q_ap = np.bincount(q_idx, res['ap'], len(queries)) / \
+        np.bincount(q_idx, minlength=len(queries))
+
+    rng = np.random.default_rng(seed)
+    R = resample_indices(rng, len(queries), n_boot)
+    return {'avg': 100 * q_ap[R].mean(axis=1)}
+
+
+#####################
+# Verification task #
+#####################
+def block_weights(rng, n, n_boot, n_blocks=VERIF_BLOCKS):
+    """Resample weights of `n_blocks` blocks of consecutive units, with the
+    block of each of the n units"""
+    n_blocks = min(n_blocks, n)
+    return resample_weights(rng, n_blocks, n_boot).astype(np.float32), \
+        np.arange(n) * n_blocks // n
+
+
+def group_counts(r, n_neg, neg_blocks, pos_blocks, groups=VERIF_GROUPS):
+    """Counts of the negatives and of the positives of a ranking, the
+    negatives first in its scores, by block and by group of the ranking
+
+    Returns the (blocks, groups) sparse counts of the negatives and of the
+    positives, and the fraction of the negatives of each group ranked
+    before the positives of the group, over all their pairs.
+    """
+    N = len(r)
+    groups = min(groups, N)
+    # the groups widen down the ranking, as the AP depends on the order of
+    # the first ranks much more than on the order of the last ones
+    g = np.minimum(np.sqrt(np.arange(N) / N) * groups,
+                   groups - 1).astype(int)
+    labels = r.labels[r.perm]
+    neg = ~labels
+    qp, qn = np.nonzero(labels)[0], np.nonzero(neg)[0]
+
+    def counts(blocks, rows, q):
+        return sparse.csr_matrix(
+            (np.ones(len(q), np.float32), (blocks[rows], g[q])),
+            shape=(blocks[-1] + 1, groups))
+
+    Nc = counts(neg_blocks, r.perm[qn], qn)
+    Pc = counts(pos_blocks, r.perm[qp] - n_neg, qp)
+
+    # negatives of its group ranked before each positive
+    n_before = np.cumsum(neg) - neg
+    start = np.searchsorted(g, np.arange(groups))
+    before = np.bincount(g[qp], n_before[qp] - n_before[start[g[qp]]],
+                         groups)
+    pairs = total(Pc) * total(Nc)
+    return Nc, Pc, before / np.maximum(pairs, 1)
+
+
+def total(C):
+    """Counts by group of all the blocks, as a single replicate"""
+    return np.asarray(C.sum(axis=0), np.float64)
+
+
+def weighted(W, C):
+    """Counts by group of the replicates with block weights W"""
+    return np.asarray((C.T @ W.T).T, np.float64)
+
+
+def grouped_auc(Nw, Pw, before):
+    """AUCs of `roc` from the counts of the negatives and of the positives
+    by group of a ranking, one row per replicate"""
+    n_after = Nw.sum(axis=1, keepdims=True) - np.cumsum(Nw, axis=1)
+    pairs = np.sum(Pw * (n_after + (1 - before) * Nw), axis=1)
+    return pairs / (Pw.sum(axis=1) * Nw.sum(axis=1))
+
+
+def grouped_ap(Nw, Pw, before):
+    """APs of `pr` from the counts of the negatives and of the positives
+    by group of a ranking, one row per replicate
+
+    The positives of a group are taken in its middle, after their share of
+    the negatives of the group.
+    """
+    tp = np.cumsum(Pw, axis=1) - Pw + (Pw + 1) / 2.0
+    fp = np.cumsum(Nw, axis=1) - Nw + before * Nw
+    p = Pw.sum(axis=1, keepdims=True)
+    return np.sum(Pw * metrics.ap_terms(tp, fp, p), axis=1)
+
+
+def verif_replicates(cache, n_boot, seed=SEED):
+    """Replicates of the verification mAP and AUC, resampling the pairs of
+    the distances in the verification cache
+
+    The pairs of the task files are in random order, so blocks of
+    `VERIF_BLOCKS` consecutive pairs are resampled instead of single
+    pairs, separately for the positives, the positives of the imbalanced
+    protocol, and each negatives, and the same for all the noise levels.
+    The scores of each metric are sorted once and counted by block and by
+    group of consecutive ranks (see `group_counts`), the counts of all the
+    replicates are then products of the block weights with these counts,
+    and their metrics are computed from them, the order within a group
+    taken from the scores. The replicates are shifted by the difference
+    between the metric computed that way and the exact one.
+    """
+    d_pos = cache['pos_dists']
+    d_negs = {'intra': cache['neg_intra_dists'],
+              'inter': cache['neg_inter_dists']}
+    n_pos = d_pos.shape[0]
+    n_imb = int(n_pos * 0.2)
+
+    rng = np.random.default_rng(seed)
+    W_pos, b_pos = block_weights(rng, n_pos, n_boot)
+    W_imb, b_imb = block_weights(rng, n_imb, n_boot)
+    W_neg, b_neg = {}, {}
+    for negs in ['intra', 'inter']:
+        W_neg[negs], b_neg[negs] = block_weights(
+            rng, d_negs[negs].shape[0], n_boot)
+
+    auc, ap = 0, 0
+    for j in range(d_pos.shape[1]):
+        r_pos = metrics.ranking(-d_pos[:, j], 1)
+        for negs in ['intra', 'inter']:
+            n_neg = d_negs[negs].shape[0]
+            r = metrics.merge_rankings(
+                metrics.ranking(-d_negs[negs][:, j], 0), r_pos)
+            if negs == 'intra':
+                Nc, Pc, before = group_counts(r, n_neg, b_neg[negs], b_pos)
+                approx = grouped_auc(total(Nc), total(Pc), before)
+                auc = auc + grouped_auc(weighted(W_neg[negs], Nc),
+                                        weighted(W_pos, Pc), before) + \
+                    r.auc() - approx
+            # positives of the imbalanced protocol
+            r = r.prefix(n_neg + n_imb)
+            Nc, Pc, before = group_counts(r, n_neg, b_neg[negs], b_imb)
+            approx = grouped_ap(total(Nc), total(Pc), before)
+            ap = ap + grouped_ap(weighted(W_neg[negs], Nc),
+                                 weighted(W_imb, Pc), before) + \
+                r.ap() - approx
+    # the balanced inter case takes the AUC of the intra negatives
+    return {'avg_balanced': 100 * auc / d_pos.shape[1],
+            'avg_imbalanced': 100 * ap / (2 * d_pos.shape[1])}
+
+
+###########
+# Results #
+###########
+def bootstrap_results(hpatches_results, results_dir='results', n_boot=1000,
+                      seed=SEED, level=CI_LEVEL):
+    """Bootstrap confidence intervals of the scores of the descriptors
+
+    The intervals of the scores of each task are set in a `ci` dict of
+    its results, e.g. `result.matching.ci['avg']`. The verification
+    intervals are computed from the distances kept in the cache of the
+    evaluation, and are left out for the descriptors without one.
+    Returns the replicates of each task score, by descriptor.
+    """
+    replicates = {}
+    for x in hpatches_results:
+        for task in ['verification', 'matching', 'retrieval']:
+            res = getattr(x, task)
+            if task == 'verification':
+                cache_path = os.path.join(
+                    results_dir, '.cache', '_'.join(
+                        (x.desc, task, x.splt['name'])) + '.npz')
+                if not os.path.exists(cache_path):
+                    print('>> No distances cached for the %s verification, '
+                          'no confidence intervals' % blue(x.desc))
+                    continue
+                with np.load(cache_path) as f:
+                    reps = verif_replicates(f, n_boot, seed)
+            elif task == 'matching':
+                reps = matching_replicates(
+                    load_results(x.desc, task, x.splt, results_dir), n_boot,
+                    seed)
+            else:
+                reps = retrieval_replicates(
+                    load_results(x.desc, task, x.splt, results_dir), n_boot,
+                    seed)
+            res.ci = {}
+            for k, v in reps.items():
+                res.ci[k] = confidence_interval(v, level)
+                replicates.setdefault((task, k), {})[x.desc] = v
+    return replicates
+
+
+def print_intervals(hpatches_results, replicates, level=CI_LEVEL):
+    """Prints the confidence intervals of the scores of the descriptors,
+    best first, and of the differences of the scores of consecutive
+    descriptors, computed on the same resamples"""
+    for (task, k), reps in sorted(replicates.items()):
+        results = sorted([x for x in hpatches_results if x.desc in reps],
+                         key=lambda x: getattr(getattr(x, task), k),
+                         reverse=True)
+        print('\n>> %s %s, %d%% confidence intervals' % (
+            blue(task), k, round(100 * level)))
+        for i, x in enumerate(results):
+            lo, hi = getattr(x, task).ci[k]
+            print('%-20s %6.2f  [%6.2f, %6.2f]' % (
+                x.desc, getattr(getattr(x, task), k), lo, hi))
+            if i + 1 < len(results):
+                y = results[i + 1]
+                lo, hi = confidence_interval(reps[x.desc] - reps[y.desc],
+                                             level)
+                print('%-20s %6.2f  [%6.2f, %6.2f]' % (
+                    '  - ' + y.desc, getattr(getattr(x, task), k) -
+                    getattr(getattr(y, task), k), lo, hi))
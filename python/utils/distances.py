@@ -0,0 +1,180 @@
+import numpy as np
+from scipy import spatial
+
+# number of rows processed at once by the batched distance routines
+chunk_size = 2 ** 16
+# maximum size in bytes of the temporary arrays built for a tile of a
+# distance matrix
+tile_bytes = 2 ** 25
+# relative accuracy of the squared L2 distances of the single precision
+# matrix products, below which they are computed again in double precision
+l2_rtol = 1e-4
+
+# number of set bits of every byte value
+popcount_lut = np.array([bin(i).count('1') for i in range(256)],
+                        dtype=np.uint8)
+
+
+def pair_dists(D1, D2, distance):
+    """Distances between the rows of two equally sized sets of descriptors
+
+    The distances are computed as `scipy.spatial.distance` does for a
+    single pair of vectors, i.e. in the precision of the descriptors, so
+    that the result is the same as calling it for every row.
+    """
+    if distance == 'L2':
+        diff = D1 - D2
+        if diff.dtype == np.float32:
+            # scipy uses the BLAS nrm2 routine, which is exact up to the
+            # final rounding to single precision
+            diff = diff.astype(np.float64)
+            return np.sqrt(np.einsum('ij,ij->i', diff, diff)).astype(
+                np.float32)
+        diff = diff.astype(np.float64, copy=False)
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    elif distance == 'HAMMING':
+        return hamming_pairs(D1, D2)
+    elif distance == 'L1':
+        return np.abs(D1 - D2).sum(axis=1)
+    else:
+        raise ValueError('Unknown distance - valid options are |L2|L1|HAMMING|')
+
+
+def cdist_pairs(D1, D2, distance):
+    """Distances between the rows of two equally sized sets of descriptors,
+    computed as the diagonal of the matrix from `utils.tasks.dist_matrix`
+
+    scipy's cdist accumulates the coordinates of each pair one after the
+    other in double precision, and so does this, vectorized over the pairs.
+    """
+    if distance == 'HAMMING':
+        return hamming_pairs(D1, D2).astype(np.float32) / 256.0
+    elif distance not in ['L2', 'L1']:
+        raise ValueError('Unknown distance - valid options are |L2|L1|HAMMING|')
+    d = np.zeros(D1.shape[0])
+    for i in range(0, D1.shape[0], chunk_size):
+        c = slice(i, i + chunk_size)
+        diff = D1[c].astype(np.float64) - D2[c].astype(np.float64)
+        for k in range(diff.shape[1]):
+            if distance == 'L2':
+                d[c] += diff[:, k] * diff[:, k]
+            else:
+                d[c] += np.abs(diff[:, k])
+    if distance == 'L2':
+        d = np.sqrt(d)
+    return d
+
+
+###########################
+# Distance matrix kernels #
+###########################
+def tiles(n1, n2, depth=1, itemsize=4):
+    """Tiles of a n1 x n2 distance matrix, as pairs of row and column slices
+
+    Tiles span at most 4096 columns, and as many rows as keep a temporary
+    array of `depth` values of `itemsize` bytes per entry of the tile
+    within `tile_bytes`.
+    """
+    bj = max(1, min(n2, 4096))
+    bi = max(1, tile_bytes // (itemsize * depth * bj))
+    return [(slice(i, i + bi), slice(j, j + bj))
+            for i in range(0, n1, bi) for j in range(0, n2, bj)]
+
+
+def l2_matrix(D1, D2, rtol=l2_rtol):
+    """L2 distance matrix between two sets of descriptors, in single
+    precision
+
+    The squared distances are expanded as |a|^2 + |b|^2 - 2 a.b, so that
+    the bulk of the work is a BLAS matrix product. The expansion loses
+    precision when the distance is small compared to the norms, so the
+    distances whose rounding error may exceed `rtol` of their square
+    (the nearest neighbours and their near ties) are computed again in
+    double precision. Set `rtol` to None to skip it.
+    """
+    D1 = np.ascontiguousarray(D1, dtype=np.float32)
+    D2 = np.ascontiguousarray(D2, dtype=np.float32)
+    n1 = np.einsum('ij,ij->i', D1, D1)
+    n2 = np.einsum('ij,ij->i', D2, D2)
+    # bound of the rounding error of the expansion, relative to the norms
+    eps = np.finfo(np.float32).eps * np.sqrt(D1.shape[1])
+    D = np.empty((D1.shape[0], D2.shape[0]), dtype=np.float32)
+    for i, j in tiles(D1.shape[0], D2.shape[0], depth=3):
+        d = np.dot(D1[i], D2[j].T)
+        d *= -2
+        d += n1[i, None]
+        d += n2[None, j]
+        np.maximum(d, 0, out=d)
+        if rtol is not None:
+            r, c = np.nonzero(rtol * d < eps * (n1[i, None] + n2[None, j]))
+            diff = D1[i][r].astype(np.float64) - D2[j][c]
+            d[r, c] = np.einsum('ij,ij->i', diff, diff)
+        D[i, j] = np.sqrt(d)
+    return D
+
+
+def l1_matrix(D1, D2):
+    """L1 distance matrix between two sets of descriptors, in single
+    precision
+
+    The matrix is computed tile by tile by scipy's compiled loop, which is
+    faster than any vectorized numpy expression of it, and only the tiles
+    are held in double precision.
+    """
+    D = np.empty((D1.shape[0], D2.shape[0]), dtype=np.float32)
+    for i, j in tiles(D1.shape[0], D2.shape[0], itemsize=8):
+        D[i, j] = spatial.distance.cdist(D1[i], D2[j], 'cityblock')
+    return D
+
+
+####################
+# Hamming distance #
+####################
+def packed_words(D):
+    """Views binary descriptors packed in bytes as rows of 64-bit words
+
+    The bytes are kept as they are when the descriptor length is not a
+    multiple of 8 bytes, or when numpy can not count the bits of 64-bit
+    words. Descriptors stored as floats (e.g. read from .csv files) are
+    cast to bytes first.
+    """
+    D = np.asarray(D)
+    if D.dtype.kind == 'f':
+        D = D.astype(np.uint8)
+    D = np.ascontiguousarray(D)
+    if D.dtype.itemsize == 1 and D.shape[1] % 8 == 0 and \
+            hasattr(np, 'bitwise_count'):
+        D = D.view(np.uint64)
+    return D
+
+
+def bitcount(x):
+    """Number of set bits of each element of an array of packed words"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return popcount_lut[x]
+
+
+def hamming_pairs(D1, D2):
+    """Hamming distances between the rows of two sets of binary descriptors"""
+    W1, W2 = packed_words(D1), packed_words(D2)
+    d = np.zeros(W1.shape[0], dtype=np.int64)
+    for k in range(W1.shape[1]):
+        d += bitcount(np.bitwise_xor(W1[:, k], W2[:, k]))
+    return d
+
+
+def hamming_matrix(D1, D2):
+    """Hamming distance matrix between two sets of binary descriptors
+
+    The matrix is computed tile by tile and word by word, so that the
+    temporary arrays never exceed `tile_bytes`.
+    """
+    W1, W2 = packed_words(D1), packed_words(D2)
+    D = np.empty((W1.shape[0], W2.shape[0]), dtype=np.int32)
+    for i, j in tiles(W1.shape[0], W2.shape[0], itemsize=8):
+        acc = D[i, j]
+        acc[:] = 0
+        for k in range(W1.shape[1]):
+            acc += bitcount(np.bitwise_xor(W1[i, k, None], W2[None, j, k]))
+    return D
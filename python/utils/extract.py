@@ -0,0 +1,192 @@
+import importlib
+import json
+import os
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+from joblib import Parallel, delayed
+from tqdm import tqdm
+from utils.hpatch import (array_hash, list_seqs, load_patches, store_dir,
+                          store_lock, tps)
+
+# number of patches given at once to a descriptor function
+BATCH_SIZE = 4096
+# width of the border replicated around each patch of a mosaic, wider than
+# what the OpenCV descriptors read around a 65x65 patch, including the
+# smoothing of the image
+MOSAIC_MARGIN = 16
+
+
+########################
+# Baseline descriptors #
+########################
+# A descriptor function takes a (patches, 65, 65) uint8 array and returns a
+# (patches, dim) array, float for real valued descriptors and uint8 for
+# binary descriptors packed in bytes.
+def meanstd(patches):
+    """Mean and standard deviation of the pixels of each patch, as in the
+    matlab baseline"""
+    x = patches.reshape(len(patches), -1).astype(np.float64)
+    return np.stack((x.mean(axis=1), x.std(axis=1, ddof=1)),
+                    axis=1).astype(np.float32)
+
+
+def mosaic(patches, margin=MOSAIC_MARGIN):
+    """Tiles the patches, each padded by replicating its border, in a single
+    image, and returns it with the coordinates of the patch centres"""
+    n, h, w = patches.shape
+    padded = np.pad(patches, ((0, 0), (margin, margin), (margin, margin)),
+                    mode='edge')
+    H, W = padded.shape[1:]
+    cols = int(np.ceil(np.sqrt(n)))
+    rows = -(-n // cols)
+    padded = np.concatenate(
+        (padded, np.zeros((rows * cols - n, H, W), padded.dtype)))
+    im = padded.reshape(rows, cols, H, W).transpose(0, 2, 1, 3)
+    i = np.arange(n)
+    x = (i % cols) * W + margin + (w - 1) / 2.
+    y = (i // cols) * H + margin + (h - 1) / 2.
+    return np.ascontiguousarray(im.reshape(rows * H, cols * W)), x, y
+
+
+def opencv_descr(extractor, patches, size):
+    """Describes the patches with an OpenCV extractor, with one upright
+    keypoint of diameter `size` at the centre of each patch
+
+    The patches are described in a single call on a mosaic of them, which
+    gives the same descriptors as describing them one by one.
+    """
+    im, x, y = mosaic(patches)
+    kps = [cv2.KeyPoint(float(a), float(b), size, 0) for a, b in zip(x, y)]
+    kps, d = extractor.compute(im, kps)
+    assert len(kps) == len(patches), \
+        "%d patches were dropped by the extractor." % (len(patches) - len(kps))
+    return d
+
+
+def sift(patches):
+    """OpenCV SIFT, with its 4x4 spatial bins spanning the patch"""
+    # the bins of a keypoint are 3 * size / 2 pixels wide
+    return opencv_descr(cv2.SIFT_create(), patches, patches.shape[2] / 6.)
+
+
+def rootsift(patches):
+    """RootSIFT, the square root of the L1 normalised SIFT"""
+    d = sift(patches)
+    d /= np.maximum(d.sum(axis=1, keepdims=True), np.finfo(np.float32).eps)
+    return np.sqrt(d)
+
+
+def orb(patches):
+    """OpenCV ORB, with its sampling pattern spanning the patch, packed in
+    32 bytes"""
+    psz = 2 * (patches.shape[2] // 2) - 1
+    return opencv_descr(cv2.ORB_create(patchSize=psz), patches, float(psz))
+
+
+descriptors = {'meanstd': meanstd, 'sift': sift, 'rootsift': rootsift,
+               'orb': orb}
+
+
+def descr_function(name):
+    """A baseline descriptor, or a `module:function` descriptor function"""
+    if name in descriptors:
+        return descriptors[name]
+    assert ':' in name, "Unknown descriptor %s - valid options are %s or " \
+        "module:function" % (name, '|'.join(sorted(descriptors)))
+    module, fun = name.split(':')
+    return getattr(importlib.import_module(module), fun)
+
+
+##############
+# Extraction #
+##############
+def extract_descrs(patch_path, descr_path, descr_fun, batch_size=BATCH_SIZE,
+                   n_jobs=-2):
+    """Describes all the patches of an HPatches release with `descr_fun`,
+    straight into the descriptor store of `descr_path`
+
+    The patches are streamed from the patch store in batches, by a pool of
+    worker processes that write the descriptors into the preallocated store
+    files. The store is complete on its own, without .csv files, and is
+    opened by `load_descrs` like any other.
+    """
+    # the store of .csv descriptors is rebuilt from them, it can not hold
+    # other descriptors
+    assert not (os.path.isdir(descr_path) and list_seqs(descr_path)), \
+        "%s holds .csv descriptors, extract into another folder." % descr_path
+    load_patches(patch_path)
+    patch_store = os.path.join(patch_path, store_dir)
+    with open(os.path.join(patch_store, 'index.json')) as f:
+        index = json.load(f)
+    ref = np.load(os.path.join(patch_store, 'ref.npy'), mmap_mode='r')
+    first = np.asarray(descr_fun(np.array(ref[:1])))
+
+    # the store is written under a name of its own, and swapped in once
+    # complete, so that an evaluation can read the previous one meanwhile
+    store_path = os.path.join(descr_path, store_dir)
+    if not os.path.isdir(descr_path):
+        os.makedirs(descr_path)
+    tmp_path = tempfile.mkdtemp(prefix=store_dir + '.', dir=descr_path)
+    try:
+        write_store(tmp_path, descr_fun, patch_store, index, first,
+                    batch_size, n_jobs)
+    except BaseException:
+        shutil.rmtree(tmp_path)
+        raise
+    with store_lock(store_path):
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+        os.rename(tmp_path, store_path)
+
+
+def write_store(tmp_path, descr_fun, patch_store, index, first, batch_size,
+                n_jobs):
+    """Describes the patches of a patch store into the new descriptor
+    store `tmp_path`"""
+    offsets = index['offsets']
+    n = offsets[-1]
+    dtype = np.uint8 if first.dtype == np.uint8 else np.float32
+    descr_type = 'bin_packed' if dtype == np.uint8 else ''
+    for t in tps:
+        np.lib.format.open_memmap(
+            os.path.join(tmp_path, t + '.npy'), mode='w+', dtype=dtype,
+            shape=(n, first.shape[1]))
+    batches = [(t, b, min(b + batch_size, n))
+               for t in tps for b in range(0, n, batch_size)]
+    Parallel(n_jobs=n_jobs)(
+        delayed(extract_batch)(descr_fun, patch_store, tmp_path, t, b, e)
+        for t, b, e in tqdm(batches, desc='Extraction'))
+    hashes = Parallel(n_jobs=n_jobs)(
+        delayed(store_hash)(tmp_path, offsets[i], offsets[i + 1])
+        for i in range(len(index['seqs'])))
+
+    # no .csv signatures, the store is the source of the descriptors
+    index = {'seqs': index['seqs'],
+             'offsets': offsets,
+             'sig': None,
+             'hashes': hashes,
+             'dim': int(first.shape[1]),
+             'descr_type': descr_type}
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+def extract_batch(descr_fun, patch_store, store_path, t, start, end):
+    """Describes rows start:end of the patches of type t into a store"""
+    patches = np.load(os.path.join(patch_store, t + '.npy'), mmap_mode='r')
+    mm = np.load(os.path.join(store_path, t + '.npy'), mmap_mode='r+')
+    d = np.asarray(descr_fun(np.array(patches[start:end])))
+    assert d.shape == (end - start, mm.shape[1]), \
+        "The descriptor function returned a %s array for %d patches." % (
+            d.shape, end - start)
+    mm[start:end] = d
+    mm.flush()
+
+
+def store_hash(store_path, start, end):
+    """Hash of the descriptors of rows start:end of a store"""
+    return array_hash([np.load(os.path.join(store_path, t + '.npy'),
+                               mmap_mode='r')[start:end] for t in tps])
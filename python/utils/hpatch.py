@@ -1,10 +1,16 @@
 import cv2
+import fcntl
+import hashlib
 import numpy as np
 from joblib import Parallel, delayed
 import multiprocessing
 import pandas as pd
 import json
 import os
+import shutil
+import struct
+import tempfile
+from contextlib import contextmanager
 
 # all types of patches
 tps = [
@@ -50,48 +56,492 @@ def load_splits(f_splits):
     return splits
 
 
-def load_descrs(path, dist='L2', descr_type='', sep=','):
-    """Loads *all* saved patch descriptors from a root folder"""
+def list_seqs(path):
+    """Lists the sequence folders inside a root folder"""
+    return sorted(os.path.join(path, d) for d in os.listdir(path)
+                  if not d.startswith('.') and
+                  os.path.isdir(os.path.join(path, d)))
+
+
+def load_descrs(path, dist='L2', descr_type='', sep=',', store=True,
+                seqs=None, n_jobs=-1):
+    """Loads *all* saved patch descriptors from a root folder
+
+    If `store` is set, the descriptors are read from the binary store kept
+    in the `.store` subfolder, which is (re)built from the .csv files the
+    first time they are loaded or whenever they change. Descriptors
+    computed by the extraction only have the store, which is read whatever
+    `store` is, with the type of descriptors it was written with.
+
+    If `seqs` is given, e.g. from `utils.tasks.task_seqs`, only the
+    descriptors of these sequences are loaded. The other sequences are
+    read from their .csv files, type by type, the first time they are
+    accessed, and are left out of the stacked descriptor matrices.
+
+    Binary descriptors (`descr_type='bin_packed'` or `dist='HAMMING'`) are
+    kept packed as bytes and always compared with the Hamming distance.
+
+    The .csv files are parsed by `n_jobs` worker processes, as in joblib.
+    """
     print('>> Please wait, loading the descriptor files...')
-    # get all folders in the descr. root folder, except the 1st which is '.'
-    t = [x[0] for x in os.walk(path)][1::]
-    try:
-        len(t) == 116
-    except Exception:
-        print("%r does not seem like a valid HPatches descriptor root folder."
-              % (path))
-    seqs_l = Parallel(n_jobs=multiprocessing.cpu_count())(
-        delayed(hpatches_descr)(f, descr_type, sep) for f in t)
-    seqs = dict((l.name, l) for l in seqs_l)
-    seqs['distance'] = dist
-    seqs['dim'] = seqs_l[0].dim
+    if descr_type == 'bin_packed' or dist == 'HAMMING':
+        descr_type, dist = 'bin_packed', 'HAMMING'
+    t = list_seqs(path)
+    store_path = os.path.join(path, store_dir)
+    descr = None
+    with store_lock(store_path):
+        index = store_index(store_path)
+        if index is not None and index['sig'] is None:
+            # written by the extraction, the store is the only copy of the
+            # descriptors, and knows their type
+            assert not t, "%s holds both .csv files and extracted " \
+                "descriptors, remove one of them." % path
+            if index['descr_type'] == 'bin_packed':
+                descr_type, dist = 'bin_packed', 'HAMMING'
+            assert index['descr_type'] == descr_type, \
+                "%s holds real valued descriptors, which can not be " \
+                "compared with the Hamming distance." % path
+            descr = open_descr_store(store_path)
+        elif store and store_is_valid(store_path, t, descr_type, seqs):
+            descr = open_descr_store(store_path, t)
+        else:
+            assert t, "%s holds no descriptors." % path
+            if len(t) != 116:
+                print("%r does not seem like a valid HPatches descriptor "
+                      "root folder." % (path))
+            if store:
+                try:
+                    build_descr_store(store_path, t, descr_type, sep, seqs,
+                                      n_jobs)
+                    descr = open_descr_store(store_path, t)
+                except (IOError, OSError):
+                    # read-only descriptor folder, the store is not kept
+                    print('>> The store of %s can not be written, the '
+                          'descriptors are parsed without keeping it.' % path)
+    if descr is None:
+        # build a throwaway store in shared memory, its files are
+        # unlinked once mapped
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        tmp_path = tempfile.mkdtemp(prefix='hpatches_', dir=shm)
+        try:
+            build_descr_store(os.path.join(tmp_path, store_dir), t,
+                              descr_type, sep, seqs, n_jobs)
+            descr = open_descr_store(os.path.join(tmp_path, store_dir))
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    for b in t:
+        name = b.split(os.path.sep)[-1]
+        if name not in descr:
+            descr[name] = hpatches_descr_lazy(b, descr_type, sep)
+    descr['distance'] = dist
     print('>> Descriptor files loaded.')
+    return descr
+
+
+####################
+# Descriptor store #
+####################
+# The descriptor store keeps, for each patch type, the descriptors of all
+# the sequences in a single contiguous .npy file, and an index with the
+# row offset of each sequence. Loading it is a matter of memory-mapping
+# the 16 files, without any parsing or copies. The index also keeps a hash
+# of the descriptors of each sequence, which the evaluation uses to only
+# recompute what depends on the sequences that changed. The store is laid
+# out for all the sequences, but filled one sequence at a time, the first
+# time it is loaded; the hash of a sequence that is not filled is None.
+# A process holds the lock of the store while it reads, lays out or fills
+# it, so that evaluations of a descriptor run in parallel, e.g. on two
+# splits, do not write its files or its index at the same time.
+store_dir = '.store'
+
+
+@contextmanager
+def store_lock(store_path):
+    """Exclusive lock of a store, in a .lock file next to it
+
+    The store of a read-only folder can not be written, and is not locked.
+    """
+    try:
+        f = open(store_path + '.lock', 'a')
+    except (IOError, OSError):
+        f = None
+    if f is None:
+        yield
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def seq_signature(base, ext='.csv'):
+    """Size and modification time of the `ext` files of a sequence"""
+    st = [os.stat(os.path.join(base, t + ext)) for t in tps]
+    return [sum(s.st_size for s in st), max(s.st_mtime_ns for s in st)]
+
+
+def store_index(store_path):
+    """Index of a store, or None if there is none, or if its offsets do not
+    match the shapes of the store files"""
+    try:
+        with open(os.path.join(store_path, 'index.json')) as f:
+            index = json.load(f)
+        shapes = [np.load(os.path.join(store_path, t + '.npy'),
+                          mmap_mode='r').shape for t in tps]
+    except (IOError, ValueError):
+        return None
+    if any(s != (index['offsets'][-1], index['dim']) for s in shapes):
+        return None
+    return index
+
+
+def store_is_valid(store_path, bases, descr_type='', seqs=None):
+    """Checks that a store exists and holds the descriptors of the `seqs`
+    (all by default) up to date with their .csv files, if it was built
+    from them"""
+    index = store_index(store_path)
+    if index is None:
+        return False
+    if index['sig'] is None:
+        # written by the extraction, see `load_descrs`
+        return False
+    names = [b.split(os.path.sep)[-1] for b in bases]
+    if index['seqs'] != names or index['descr_type'] != descr_type or \
+            'hashes' not in index:
+        return False
+    return all(index['hashes'][i] is not None and
+               index['sig'][i] == seq_signature(b)
+               for i, b in enumerate(bases) if seqs is None or names[i] in seqs)
+
+
+def count_rows(path):
+    """Number of lines of a text file"""
+    n, last = 0, b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 24), b''):
+            n += block.count(b'\n')
+            last = block[-1:]
+    return n + (last != b'\n')
+
+
+def build_descr_store(store_path, bases, descr_type='', sep=',',
+                      seqs=None, n_jobs=-1):
+    """Parses the .csv files of the sequence folders `bases` into a store
+
+    Only the sequences in `seqs` (all by default) that are missing from
+    the store, or changed since, are parsed. The store files are laid out
+    from the row counts of the .csv files, again if any of these changed,
+    and the parallel workers write the descriptors they parse straight
+    into them, so only metadata is sent back to the parent process. The
+    index is read, updated and written again under the lock of the store
+    held by `load_descrs`.
+    """
+    bases = sorted(bases)
+    names = [b.split(os.path.sep)[-1] for b in bases]
+    todo = [i for i, n in enumerate(names) if seqs is None or n in seqs]
+    index = store_index(store_path)
+    if index is not None and (index['sig'] is None or
+                              index['seqs'] != names or
+                              index['descr_type'] != descr_type or
+                              'hashes' not in index):
+        index = None
+    if index is not None:
+        todo = [i for i in todo if index['hashes'][i] is None or
+                index['sig'][i] != seq_signature(bases[i])]
+        N = Parallel(n_jobs=n_jobs)(
+            delayed(count_rows)(os.path.join(bases[i], 'ref.csv'))
+            for i in todo)
+        offsets = index['offsets']
+        if any(n != offsets[i + 1] - offsets[i] for i, n in zip(todo, N)):
+            index = None
+    if index is None:
+        index = layout_descr_store(store_path, bases, descr_type, sep,
+                                   n_jobs)
+        todo = [i for i, n in enumerate(names) if seqs is None or n in seqs]
+
+    offsets = index['offsets']
+    hashes = Parallel(n_jobs=n_jobs)(
+        delayed(fill_descr_store)(store_path, bases[i], offsets[i],
+                                  offsets[i + 1], descr_type, sep)
+        for i in todo)
+    for i, h in zip(todo, hashes):
+        index['sig'][i] = seq_signature(bases[i])
+        index['hashes'][i] = h
+    with open(os.path.join(store_path, 'index.tmp.json'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(store_path, 'index.tmp.json'),
+               os.path.join(store_path, 'index.json'))
+
+
+def layout_descr_store(store_path, bases, descr_type='', sep=',',
+                       n_jobs=-1):
+    """Creates an empty store for the sequence folders `bases`, and returns
+    its index"""
+    assert bases, "There are no sequence folders to lay a store out for."
+    N = Parallel(n_jobs=n_jobs)(
+        delayed(count_rows)(os.path.join(b, 'ref.csv')) for b in bases)
+    offsets = np.hstack((0, np.cumsum(N))).astype(np.int64)
+    first = read_descr_csv(os.path.join(bases[0], 'ref.csv'), descr_type, sep)
+    assert first.shape[1] != 1, \
+        "Problem loading the .csv files. Please check the delimiter."
+
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for t in tps:
+        np.lib.format.open_memmap(
+            os.path.join(tmp_path, t + '.npy'), mode='w+', dtype=first.dtype,
+            shape=(int(offsets[-1]), first.shape[1]))
+    index = {'seqs': [b.split(os.path.sep)[-1] for b in bases],
+             'offsets': offsets.tolist(),
+             'sig': [None] * len(bases),
+             'hashes': [None] * len(bases),
+             'dim': int(first.shape[1]),
+             'descr_type': descr_type}
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(tmp_path, store_path)
+    return index
+
+
+def fill_descr_store(store_path, base, start, end, descr_type='', sep=','):
+    """Parses the .csv files of a sequence into rows start:end of a store,
+    and returns the hash of its descriptors"""
+    dfs = []
+    for t in tps:
+        df = read_descr_csv(os.path.join(base, t + '.csv'), descr_type, sep)
+        mm = np.load(os.path.join(store_path, t + '.npy'), mmap_mode='r+')
+        assert df.shape == (end - start, mm.shape[1]), \
+            "%s/%s.csv does not have the size of the other files." % (base, t)
+        mm[start:end] = df
+        mm.flush()
+        del mm
+        dfs.append(df)
+    return array_hash(dfs)
+
+
+def open_descr_store(store_path, bases=None):
+    """Memory-maps a descriptor store
+
+    If the store was built from the .csv files of the sequence folders
+    `bases`, the sequences whose .csv files changed since are left out.
+    """
+    with open(os.path.join(store_path, 'index.json')) as f:
+        index = json.load(f)
+    data = dict((t, np.load(os.path.join(store_path, t + '.npy'),
+                            mmap_mode='r')) for t in tps)
+    offsets = index['offsets']
+    # only the sequences the store was filled with, and that are up to date
+    filled = [i for i, h in enumerate(index['hashes']) if h is not None]
+    if bases is not None:
+        bases = dict((b.split(os.path.sep)[-1], b) for b in bases)
+        filled = [i for i in filled if index['seqs'][i] in bases and
+                  index['sig'][i] == seq_signature(bases[index['seqs'][i]])]
+    seqs = {}
+    for i in filled:
+        name = index['seqs'][i]
+        seqs[name] = hpatches_descr_view(
+            name, data, offsets[i], offsets[i + 1])
+    seqs['dim'] = index['dim']
+    seqs['store'] = data
+    seqs['offsets'] = dict((index['seqs'][i], offsets[i]) for i in filled)
+    seqs['hashes'] = dict((index['seqs'][i], index['hashes'][i])
+                          for i in filled)
+    return seqs
+
+
+def array_hash(arrays):
+    """Hash of the types, shapes and contents of a list of arrays"""
+    h = hashlib.sha1()
+    for a in arrays:
+        h.update(('%s%s' % (a.dtype.str, a.shape)).encode())
+        h.update(np.ascontiguousarray(a).data)
+    return h.hexdigest()
+
+
+def descr_hashes(descr):
+    """Hash of the descriptors of each sequence, as kept in the store
+    index, or computed the first time they are requested"""
+    if 'hashes' not in descr:
+        descr['hashes'] = dict(
+            (k, array_hash([getattr(v, t) for t in tps]))
+            for k, v in descr.items() if hasattr(v, 'itr'))
+    return descr['hashes']
+
+
+def descr_matrix(descr, t):
+    """Descriptors of type t of all the sequences stacked in a single matrix
+
+    Returns the matrix and a dict with the row offset of each sequence.
+    For a store the memory-mapped array is returned as it is, otherwise
+    the matrix is built the first time it is requested.
+    """
+    if 'offsets' not in descr:
+        names = sorted(k for k, v in descr.items() if hasattr(v, 'itr'))
+        offsets = np.hstack((0, np.cumsum([descr[n].N for n in names])))
+        descr['offsets'] = dict(zip(names, offsets[:-1].tolist()))
+        descr['store'] = {}
+    if t not in descr['store']:
+        names = sorted(descr['offsets'], key=descr['offsets'].get)
+        descr['store'][t] = np.concatenate(
+            [getattr(descr[n], t) for n in names])
+    return descr['store'][t], descr['offsets']
+
+
+def read_descr_csv(path, descr_type='', sep=','):
+    """Reads a descriptor .csv file
+
+    Values are parsed straight into float32, without a float64 copy, and
+    binary descriptors, packed in bytes, are then kept as uint8.
+    """
+    engine = 'c' if len(sep) == 1 else 'python'
+    df = pd.read_csv(path, header=None, sep=sep, engine=engine,
+                     dtype=np.float32).to_numpy()
+    if descr_type == "bin_packed":
+        assert np.all((df >= 0) & (df <= 255) & (df == np.floor(df))), \
+            "%s does not hold descriptor bits packed in bytes." % path
+        df = df.astype(np.uint8)
+    return df
+
+
+###############
+# Patch store #
+###############
+# The patch store keeps the patches of all the sequences of an HPatches
+# release decoded in a (patches, 65, 65) uint8 .npy file per patch type,
+# with the row offset of each sequence, in the same layout as the
+# descriptor store. It is memory-mapped, so the pages of the patches are
+# shared by all the processes that use them.
+def load_patches(path):
+    """Loads the patches of all the sequences of an HPatches release
+
+    The patches are read from the patch store kept in the `.store`
+    subfolder, which is (re)built from the .png files the first time they
+    are loaded or whenever they change.
+    """
+    bases = list_seqs(path)
+    store_path = os.path.join(path, store_dir)
+    if not patch_store_is_valid(store_path, bases):
+        build_patch_store(store_path, bases)
+    return open_patch_store(store_path)
+
+
+def patch_store_is_valid(store_path, bases):
+    """Checks that a patch store exists and is up to date with the .png
+    files"""
+    try:
+        with open(os.path.join(store_path, 'index.json')) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return False
+    if index['seqs'] != [b.split(os.path.sep)[-1] for b in bases]:
+        return False
+    return all(index['sig'][i] == seq_signature(b, '.png')
+               for i, b in enumerate(bases))
+
+
+def png_height(path):
+    """Height of a .png image, read from its header"""
+    with open(path, 'rb') as f:
+        return struct.unpack('>I', f.read(24)[20:24])[0]
+
+
+def build_patch_store(store_path, bases):
+    """Decodes the .png files of the sequence folders `bases` into a
+    patch store, preallocated from the image heights in the .png headers"""
+    bases = sorted(bases)
+    N = [png_height(os.path.join(b, 'ref.png')) // 65 for b in bases]
+    offsets = np.hstack((0, np.cumsum(N))).astype(np.int64)
+
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for t in tps:
+        np.lib.format.open_memmap(
+            os.path.join(tmp_path, t + '.npy'), mode='w+', dtype=np.uint8,
+            shape=(int(offsets[-1]), 65, 65))
+    Parallel(n_jobs=multiprocessing.cpu_count())(
+        delayed(fill_patch_store)(tmp_path, b, offsets[i], offsets[i + 1])
+        for i, b in enumerate(bases))
+
+    index = {'seqs': [b.split(os.path.sep)[-1] for b in bases],
+             'offsets': offsets.tolist(),
+             'sig': [seq_signature(b, '.png') for b in bases]}
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(tmp_path, store_path)
+
+
+def fill_patch_store(store_path, base, start, end):
+    """Decodes the .png files of a sequence into rows start:end of a
+    patch store"""
+    for t in tps:
+        im = cv2.imread(os.path.join(base, t + '.png'), 0)
+        mm = np.load(os.path.join(store_path, t + '.npy'), mmap_mode='r+')
+        assert im.shape == ((end - start) * 65, 65), \
+            "%s/%s.png does not have the size of the other files." % (base, t)
+        mm[start:end] = im.reshape(-1, 65, 65)
+        mm.flush()
+        del mm
+
+
+def open_patch_store(store_path):
+    """Memory-maps a patch store"""
+    with open(os.path.join(store_path, 'index.json')) as f:
+        index = json.load(f)
+    data = dict((t, np.load(os.path.join(store_path, t + '.npy'),
+                            mmap_mode='r')) for t in tps)
+    offsets = index['offsets']
+    seqs = {}
+    for i, name in enumerate(index['seqs']):
+        seqs[name] = hpatches_sequence_view(
+            name, data, offsets[i], offsets[i + 1])
     return seqs
 
 
 ################################
 # Patch and descriptor classes #
 ################################
-class hpatches_descr:
-    """Class for loading an HPatches descriptor result .csv file"""
+class hpatches_descr_lazy:
+    """Class for the descriptors of a sequence, each type loaded from its
+    .csv file the first time it is accessed"""
     itr = tps
 
     def __init__(self, base, descr_type='', sep=','):
         self.base = base
         self.name = base.split(os.path.sep)[-1]
+        self.descr_type = descr_type
+        self.sep = sep
+
+    def __getattr__(self, t):
+        if t == 'N':
+            return self.ref.shape[0]
+        if t == 'dim':
+            return self.ref.shape[1]
+        if t not in self.itr:
+            raise AttributeError(t)
+        df = read_descr_csv(os.path.join(self.base, t + '.csv'),
+                            self.descr_type, self.sep)
+        setattr(self, t, df)
+        return df
 
+
+class hpatches_descr_view:
+    """Class for the descriptors of a sequence held in a descriptor store"""
+    itr = tps
+
+    def __init__(self, name, data, start, end):
+        self.name = name
+        self.start = start
         for t in self.itr:
-            descr_path = os.path.join(base, t + '.csv')
-            df = pd.read_csv(descr_path, header=None, sep=sep).values
-            df = df.astype(np.float32)
-            if descr_type == "bin_packed":
-                df = df.astype(np.uint8)
-                df = np.unpackbits(df, axis=1)
-            setattr(self, t, df)
-            self.N = df.shape[0]
-            self.dim = df.shape[1]
-            assert self.dim != 1, \
-                "Problem loading the .csv files. Please check the delimiter."
+            setattr(self, t, data[t][start:end])
+        self.N = end - start
+        self.dim = data[self.itr[0]].shape[1]
 
 
 class hpatches_sequence:
@@ -105,5 +555,17 @@ class hpatches_sequence:
         for t in self.itr:
             im_path = os.path.join(base, t + '.png')
             im = cv2.imread(im_path, 0)
-            self.N = im.shape[0] / 65
-            setattr(self, t, np.split(im, self.N))
+            self.N = im.shape[0] // 65
+            setattr(self, t, im.reshape(self.N, 65, 65))
+
+
+class hpatches_sequence_view:
+    """Class for the patches of a sequence held in a patch store"""
+    itr = tps
+
+    def __init__(self, name, data, start, end):
+        self.name = name
+        self.start = start
+        for t in self.itr:
+            setattr(self, t, data[t][start:end])
+        self.N = end - start
@@ -1,3 +1,7 @@
+import os
+import shutil
+import tempfile
+
 import numpy as np
 
 # TODO: add documentation
@@ -34,7 +38,16 @@ def tpfp(scores, labels, numpos=None):
 
 def pr(scores, labels, numpos=None):
     [tp, fp, p, n, perm] = tpfp(scores, labels, numpos)
+    return pr_from_counts(tp, fp, p)
+
+
+def roc(scores, labels, numpos=None):
+    [tp, fp, p, n, perm] = tpfp(scores, labels, numpos)
+    return roc_from_counts(tp, fp, p, n)
+
 
+def pr_from_counts(tp, fp, p):
+    """Precision, recall and AP from the cumulative counts of `tpfp`"""
     # compute precision and recall
     small = 1e-10
     recall = tp / float(np.maximum(p, small))
@@ -43,12 +56,340 @@ def pr(scores, labels, numpos=None):
     return precision, recall, np.trapz(precision, recall)
 
 
-def roc(scores, labels, numpos=None):
-    [tp, fp, p, n, perm] = tpfp(scores, labels, numpos)
-
+def roc_from_counts(tp, fp, p, n):
+    """FPR, TPR and AUC from the cumulative counts of `tpfp`"""
     # compute tpr and fpr
     small = 1e-10
     tpr = tp / float(np.maximum(p, small))
     fpr = fp / float(np.maximum(n, small))
 
     return fpr, tpr, np.trapz(tpr, fpr)
+
+
+class ranking:
+    """Scores sorted once in decreasing order, ties in the order they are
+    given, as `tpfp` sorts them, together with their labels
+
+    The ranking of a concatenation of scores is merged from the rankings
+    of the parts (see `merge_rankings`), and the ranking of a prefix of
+    the scores is taken from the ranking of all of them, so none of them
+    sorts the scores again. The curves and areas are those `roc` and `pr`
+    give for the same scores and labels.
+    """
+
+    def __init__(self, scores, labels, perm=None):
+        self.scores = np.asarray(scores).ravel()
+        self.labels = np.broadcast_to(
+            np.asarray(labels).ravel() == 1, self.scores.shape)
+        if perm is None:
+            perm = np.argsort(-self.scores, kind='mergesort')
+        self.perm = perm
+
+    def __len__(self):
+        return self.scores.shape[0]
+
+    def prefix(self, k):
+        """Ranking of the first k scores"""
+        return ranking(self.scores[:k], self.labels[:k],
+                       self.perm[self.perm < k])
+
+    def tpfp(self, numpos=None):
+        """Cumulative counts of the ranked positives and negatives, as
+        `tpfp`"""
+        p = int(np.sum(self.labels))
+        n = len(self) - p
+        if numpos is not None:
+            assert(numpos >= p), \
+                'numpos smaller that number of positives in labels'
+            p = numpos
+        # assume that data with -INF score is never retrieved
+        perm = self.perm[self.scores[self.perm] > -np.inf]
+        labels = self.labels[perm]
+        tp = np.hstack((0, np.cumsum(labels)))
+        fp = np.hstack((0, np.cumsum(~labels)))
+        return tp, fp, p, n, perm
+
+    def pr(self, numpos=None):
+        tp, fp, p, n, _ = self.tpfp(numpos)
+        return pr_from_counts(tp, fp, p)
+
+    def roc(self, numpos=None):
+        tp, fp, p, n, _ = self.tpfp(numpos)
+        return roc_from_counts(tp, fp, p, n)
+
+    def ap(self, numpos=None):
+        return self.pr(numpos)[2]
+
+    def auc(self, numpos=None):
+        return self.roc(numpos)[2]
+
+
+def merge_rankings(a, b):
+    """Ranking of the scores of `a` followed by the scores of `b`
+
+    The position of each score in the merged ranking is its position in
+    its own ranking plus the number of scores of the other one ranked
+    before it, found by binary search, with ties of `a` ranked first.
+    """
+    sa, sb = -a.scores[a.perm], -b.scores[b.perm]
+    perm = np.empty(len(a) + len(b), dtype=np.intp)
+    perm[np.arange(len(a)) + np.searchsorted(sb, sa, side='left')] = a.perm
+    perm[np.arange(len(b)) + np.searchsorted(sa, sb, side='right')] = \
+        b.perm + len(a)
+    return ranking(np.concatenate((a.scores, b.scores)),
+                   np.concatenate((a.labels, b.labels)), perm)
+
+
+def pr_at_ranks(scores, labels, ranks):
+    """Average precision of every row of `scores` restricted to its first
+    k entries, for each k in `ranks`.
+
+    Gives the same result as `pr(scores[i, 0:k], labels[i, 0:k])` for
+    every row i and every k, but each row is sorted only once and the APs
+    of all the prefixes are derived from cumulative counts of the
+    negatives ranked before each positive.
+    Returns an array of shape (rows, len(ranks)).
+    """
+    scores = np.atleast_2d(scores)
+    labels = np.broadcast_to(labels, scores.shape) == 1
+    n_rows, R = scores.shape[0], len(ranks)
+    perm = np.argsort(-scores, kind='mergesort', axis=1)
+    # assume that data with -INF score is never retrieved
+    retrieved = np.take_along_axis(scores, perm, axis=1) > -np.inf
+    positive = np.take_along_axis(labels, perm, axis=1) & retrieved
+    # first of the prefixes that contains each entry
+    bucket = np.searchsorted(ranks, np.arange(scores.shape[1]), side='right')
+    bucket = bucket[perm]
+
+    # count the negatives by number of positives ranked before them and
+    # by prefix, accumulated over both
+    seg = np.cumsum(positive, axis=1)
+    n_pos = seg[:, -1]
+    P = int(n_pos.max()) if n_rows else 0
+    neg = ~positive & retrieved & (bucket < R)
+    key = (np.arange(n_rows)[:, None] * (P + 1) + seg) * R + bucket
+    counts = np.bincount(key[neg], minlength=n_rows * (P + 1) * R)
+    counts = counts.reshape(n_rows, P + 1, R).cumsum(axis=1).cumsum(axis=2)
+
+    # prefix of the ranked positives, in ranking order
+    rows, cols = np.nonzero(positive)
+    ranked = np.arange(P) < n_pos[:, None]
+    pos_bucket = np.full((n_rows, P), R)
+    pos_bucket[ranked] = bucket[rows, cols]
+
+    small = 1e-10
+    ap = np.zeros((n_rows, R))
+    for j, k in enumerate(ranks):
+        # positives in the prefix, including the ones never retrieved
+        p = np.sum(labels[:, 0:k], axis=1, keepdims=True)
+        in_k = ranked & (pos_bucket <= j)
+        tp = np.cumsum(in_k, axis=1)
+        r = tp + counts[:, 0:P, j]
+        # trapezoid between the curve points before and after each positive
+        recall = tp / np.maximum(p, small)
+        recall_prev = (tp - 1) / np.maximum(p, small)
+        precision = np.maximum(tp, small) / np.maximum(r, small)
+        precision_prev = np.maximum(tp - 1, small) / np.maximum(r - 1, small)
+        area = (recall - recall_prev) * (precision + precision_prev) / 2.0
+        ap[:, j] = np.sum(np.where(in_k, area, 0), axis=1)
+    return ap
+
+
+#####################
+# Streaming metrics #
+#####################
+# For score sets too large to be kept in memory, the scores are fed in
+# chunks, as they are produced, to an object that keeps what is needed for
+# their AUC and AP within a memory budget. Among scores of positives and
+# negatives that are equal, the negatives are ranked first, as `roc` and
+# `pr` rank them when the negatives come first in the scores, as in the
+# verification task. Scores of -INF are never retrieved.
+#
+#   s = sorted_runs()
+#   for chunk in chunks:
+#       s.add(chunk_scores, chunk_labels)
+#   auc, ap = s.auc(), s.ap()
+
+# number of positives processed at once when the metrics are computed
+stream_chunk = 2 ** 20
+
+
+def ap_terms(tp, fp, p):
+    """Area under the PR curve of `pr` added by each positive, given the
+    number of positives `tp` up to and including it and of negatives `fp`
+    ranked before it"""
+    small = 1e-10
+    precision = tp / (tp + fp)
+    precision_prev = np.maximum(tp - 1, small) / np.maximum(tp - 1 + fp, small)
+    return (precision + precision_prev) / (2.0 * np.maximum(p, small))
+
+
+class sorted_runs:
+    """Exact AUC and AP of scores fed in chunks, in bounded memory
+
+    The scores of the positives and of the negatives are buffered until
+    they take `mem_budget` bytes, then sorted and written as a run to a
+    file in `folder` (a temporary folder by default). The metrics count,
+    for each positive, the positives and negatives ranked before it with
+    a binary search in every run, so the runs never need to be merged.
+    They are those of `roc` and `pr`, up to rounding.
+    """
+
+    def __init__(self, mem_budget=2 ** 28, folder=None):
+        self.mem_budget = mem_budget
+        self.folder = folder
+        self.tmp = None
+        # sorted runs and buffered chunks of scores, of negatives and
+        # positives
+        self.runs = ([], [])
+        self.chunks = ([], [])
+        self.n_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, scores, labels):
+        """Adds a chunk of scores with their labels"""
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        labels = np.broadcast_to(np.asarray(labels).ravel() == 1,
+                                 scores.shape)
+        self.chunks[0].append(scores[~labels])
+        self.chunks[1].append(scores[labels])
+        self.n_bytes += scores.nbytes
+        if self.n_bytes > self.mem_budget:
+            self.flush(spill=True)
+
+    def flush(self, spill=False):
+        """Sorts the buffered scores into runs, written to disk if `spill`"""
+        for l in (0, 1):
+            if not self.chunks[l]:
+                continue
+            run = np.sort(np.concatenate(self.chunks[l]))
+            self.chunks[l][:] = []
+            if spill:
+                if self.tmp is None:
+                    self.tmp = tempfile.mkdtemp(prefix='hpatches_',
+                                                dir=self.folder)
+                path = os.path.join(self.tmp, '%i.npy' % len(os.listdir(
+                    self.tmp)))
+                np.save(path, run)
+                run = np.load(path, mmap_mode='r')
+            self.runs[l].append(run)
+        self.n_bytes = 0
+
+    def close(self):
+        """Deletes the runs written to disk"""
+        self.runs = ([], [])
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            self.tmp = None
+
+    def counts(self):
+        """Number of positives p, of negatives n and of retrieved negatives,
+        and, by chunks of positives, the number of positives up to and
+        including each of them and of negatives ranked before it"""
+        self.flush()
+        neg, pos = self.runs
+        p = sum(len(r) for r in pos)
+        n = sum(len(r) for r in neg)
+        n_ret = n - sum(np.searchsorted(r, -np.inf, side='right') for r in neg)
+        yield p, n, n_ret
+        for i, run in enumerate(pos):
+            # the positives never retrieved are left out
+            start = np.searchsorted(run, -np.inf, side='right')
+            for b in range(start, len(run), stream_chunk):
+                s = np.asarray(run[b:b + stream_chunk])
+                # ties of the positives are ranked by run, then from the
+                # end of each run
+                tp = len(run) - np.arange(b, b + len(s))
+                for j, other in enumerate(pos):
+                    if j != i:
+                        tp += len(other) - np.searchsorted(
+                            other, s, side='left' if j < i else 'right')
+                fp = np.zeros(len(s), dtype=np.int64)
+                for other in neg:
+                    fp += len(other) - np.searchsorted(other, s, side='left')
+                yield tp, fp
+
+    def auc(self):
+        """Area under the ROC curve of `roc`"""
+        counts = self.counts()
+        p, n, n_ret = next(counts)
+        area = sum(np.sum(n_ret - fp) for _, fp in counts)
+        return area / float(np.maximum(p * n, 1e-10))
+
+    def ap(self):
+        """Average precision, as the area under the PR curve of `pr`"""
+        counts = self.counts()
+        p, _, _ = next(counts)
+        return sum(np.sum(ap_terms(tp, fp, p)) for tp, fp in counts)
+
+
+class score_histogram:
+    """Certified bounds of the AUC and AP of scores fed in chunks, in fixed
+    memory
+
+    The positives and negatives are counted in `bins` bins of equal width
+    between `lo` and `hi`, and two more for the scores out of that range.
+    The bins are ranked, but not the scores within a bin, so the metrics
+    are bounded by those of the rankings of each bin with all its
+    negatives first, and with all its positives first. The bounds are
+    returned as (lower, upper) pairs, which get as tight as the bins are
+    fine.
+    """
+
+    def __init__(self, lo, hi, bins=2 ** 20):
+        self.lo = lo
+        self.scale = bins / float(hi - lo)
+        self.bins = bins
+        # counts of the negatives and positives per bin, from the lowest
+        # scores, and of the ones never retrieved
+        self.hist = np.zeros((2, bins + 2), dtype=np.int64)
+        self.n_inf = np.zeros(2, dtype=np.int64)
+
+    def add(self, scores, labels):
+        """Adds a chunk of scores with their labels"""
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        labels = np.broadcast_to(np.asarray(labels).ravel() == 1,
+                                 scores.shape)
+        ret = scores > -np.inf
+        self.n_inf += [np.sum(~labels & ~ret), np.sum(labels & ~ret)]
+        # the bin of a score is a non-decreasing function of it
+        b = np.clip(np.floor((scores[ret] - self.lo) * self.scale),
+                    -1, self.bins).astype(np.int64) + 1
+        self.hist += np.bincount(b + labels[ret] * (self.bins + 2),
+                                 minlength=2 * (self.bins + 2)).reshape(2, -1)
+
+    def ranked(self):
+        """Counts of the negatives and positives per bin, from the highest
+        scores, with the number of each ranked in the bins before"""
+        neg, pos = self.hist[:, ::-1]
+        return (neg, pos, np.cumsum(neg) - neg, np.cumsum(pos) - pos)
+
+    def auc(self):
+        """Bounds of the area under the ROC curve of `roc`"""
+        neg, pos, n_before, _ = self.ranked()
+        n_ret = np.sum(neg)
+        pn = float(np.maximum((np.sum(pos) + self.n_inf[1]) *
+                              (n_ret + self.n_inf[0]), 1e-10))
+        lower = np.sum(pos * (n_ret - n_before - neg)) / pn
+        upper = np.sum(pos * (n_ret - n_before)) / pn
+        return lower, upper
+
+    def ap(self):
+        """Bounds of the average precision, as the area under the PR curve
+        of `pr`"""
+        neg, pos, n_before, _ = self.ranked()
+        p = np.sum(pos) + self.n_inf[1]
+        last = np.cumsum(pos)
+        lower, upper = 0.0, 0.0
+        for b in range(0, int(last[-1]), stream_chunk):
+            # bin of each positive, ranked from the highest scores
+            k = np.arange(b, min(b + stream_chunk, last[-1]))
+            bin_ = np.searchsorted(last, k, side='right')
+            lower += np.sum(ap_terms(k + 1, n_before[bin_] + neg[bin_], p))
+            upper += np.sum(ap_terms(k + 1, n_before[bin_], p))
+        return lower, upper
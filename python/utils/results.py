@@ -1,9 +1,9 @@
 import itertools
+import json
 import operator
 import os.path
 from collections import defaultdict
 
-import dill
 import matplotlib.lines as mlines
 import matplotlib.pyplot as plt
 import numpy as np
@@ -12,25 +12,74 @@ from utils.config import desc_info, figure_attributes
 ft = {'e': 'Easy', 'h': 'Hard', 't': 'Tough'}
 
 
-class DescriptorMatchingResult:
-    def __init__(self, desc, splt, results_dir='results'):
-        matching_results = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
-        res = dill.load(open(os.path.join(results_dir, desc + "_matching_" + splt['name'] + ".p"), "rb"))
+def load_results(desc, task, splt, results_dir='results'):
+    """Columns of the results of a task, read from its .npz result file,
+    or converted from a legacy dill pickle if there is none"""
+    path = os.path.join(results_dir, desc + "_" + task + "_" + splt['name'])
+    if os.path.exists(path + ".npz"):
+        with np.load(path + ".npz") as f:
+            return {k: f[k] for k in f.files}
+
+    # dill is only needed for the results of older versions
+    import dill
+    with open(path + ".p", "rb") as f:
+        res = dill.load(f)
+    if task == 'verification':
+        metric = {'balanced': 'auc', 'imbalanced': 'ap'}
+        rows = [(t, n, b, res[t][n][b][metric[b]]) for t in ft.keys()
+                for n in ['intra', 'inter'] for b in metric]
+        names = ['noise', 'negs', 'balance', 'score']
+    elif task == 'matching':
+        rows = [(seq, t, idx, res[seq][t][idx]['ap']) for seq in res
+                for t in ft.keys() for idx in range(1, 6)]
+        names = ['seq', 'noise', 'idx', 'ap']
+    else:
+        rows = [(q, t, psize, res[q][t][psize]['ap']) for q in res
+                for t in ft.keys() for psize in sorted(res[q][t])]
+        names = ['query', 'noise', 'pool', 'ap']
+    return {k: np.array(c) for k, c in zip(names, zip(*rows))}
 
-        for seq in res:
-            seq_type = seq.split("_")[0]
-            for t in ft.keys():
-                APs = [res[seq][t][idx]['ap'] for idx in range(1, 6)]
-                mAP = np.mean(APs)
-                matching_results[t][seq_type][seq] = mAP
+
+class DescriptorTaskResult:
+    """Aggregate results of a descriptor for a task, computed from its
+    result file by the `aggregate` method of the task subclass, or
+    restored from the `summary` of a results index"""
+    task = None
+
+    def __init__(self, desc, splt, results_dir='results', summary=None):
+        self.desc = desc
+        self.splt = splt
+        if summary is None:
+            self.aggregate(load_results(desc, self.task, splt, results_dir))
+        else:
+            self.__dict__.update(summary)
+
+    def summary(self):
+        return {k: float(v) for k, v in vars(self).items()
+                if k not in ('desc', 'splt', 'ci')}
+
+
+class DescriptorMatchingResult(DescriptorTaskResult):
+    task = 'matching'
+
+    def aggregate(self, res):
+        # mAP of each sequence over its 5 images
+        seqs, seq_idx = np.unique(res['seq'], return_inverse=True)
+        seq_types = np.array([seq.split("_")[0] for seq in seqs])
+        matching_results = defaultdict(dict)
+        for t in ft.keys():
+            m = res['noise'] == t
+            mAP = np.bincount(seq_idx[m], res['ap'][m], len(seqs)) / \
+                np.bincount(seq_idx[m], minlength=len(seqs))
+            for seq_type in ['v', 'i']:
+                matching_results[t][seq_type] = mAP[seq_types == seq_type]
 
         cases = list(itertools.product(ft.keys(), ['v', 'i']))
         self.avg_v, self.avg_i = 0, 0
 
         for itm in cases:
             noise_type, seq_type = itm[0], itm[1]
-            val = 100 * np.mean(
-                list(matching_results[noise_type][seq_type].values()))
+            val = 100 * np.mean(matching_results[noise_type][seq_type])
             setattr(self, str(itm), val)
             setattr(self, "avg_" + seq_type, getattr(self, "avg_" + seq_type) + val)
 
@@ -40,39 +89,25 @@ class DescriptorMatchingResult:
         self.avg = (self.avg_i + self.avg_v) / 2.0
 
 
-class DescriptorRetrievalResult:
-    def __init__(self, desc, splt, results_dir='results'):
-        self.e, self.h, self.t = None, None, None
-        res = dill.load(open(os.path.join(results_dir, desc + "_retrieval_" + splt['name'] + ".p"), "rb"))
+class DescriptorRetrievalResult(DescriptorTaskResult):
+    task = 'retrieval'
 
-        retrieval_results = defaultdict(lambda: defaultdict(dict))
+    def aggregate(self, res):
+        self.e, self.h, self.t = None, None, None
         pool_sizes = [100, 500, 1000, 5000, 10000, 15000, 20000]
-        for psize in pool_sizes:
-            for t in ft.keys():
-                retrieval_results[t][psize] = []
-
-        for q_idx in res.keys():
-            for t in ft.keys():
-                for psize in pool_sizes:
-                    retrieval_results[t][psize].append(
-                        100 * res[q_idx][t][psize]['ap'])
-
         for t in ft.keys():
             avg_t = 0
             for psize in pool_sizes:
-                avg_t += np.mean(retrieval_results[t][psize])
+                m = (res['noise'] == t) & (res['pool'] == psize)
+                avg_t += np.mean(100 * res['ap'][m])
             setattr(self, t, avg_t / float(len(pool_sizes)))
         self.avg = (self.e + self.h + self.t) / 3.0
 
 
-class DescriptorVerificationResult:
-    def __init__(self, desc, splt, results_dir='results'):
-        metric = {'balanced': 'auc', 'imbalanced': 'ap'}
-        self.desc = desc
-        self.splt = splt
+class DescriptorVerificationResult(DescriptorTaskResult):
+    task = 'verification'
 
-        file_path = os.path.join(results_dir, self.desc + "_verification_" + self.splt['name'] + ".p")
-        res = dill.load(open(file_path, "rb"))
+    def aggregate(self, res):
         cases = list(itertools.product(ft.keys(), ['intra', 'inter'], ['balanced', 'imbalanced']))
 
         self.avg_balanced = 0
@@ -80,7 +115,9 @@ class DescriptorVerificationResult:
 
         for itm in cases:
             noise_type, negs_type, balance_type = itm[0], itm[1], itm[2]
-            val = 100 * res[noise_type][negs_type][balance_type][metric[balance_type]]
+            m = (res['noise'] == noise_type) & (res['negs'] == negs_type) & \
+                (res['balance'] == balance_type)
+            val = 100 * res['score'][m][0]
             setattr(self, str(itm), val)
             setattr(self, "avg_" + balance_type, getattr(self, "avg_" + balance_type) + val)
 
@@ -89,13 +126,73 @@ class DescriptorVerificationResult:
         self.avg_imbalanced = self.avg_imbalanced / n_samples
 
 
+task_results = {'verification': DescriptorVerificationResult,
+                'matching': DescriptorMatchingResult,
+                'retrieval': DescriptorRetrievalResult}
+
+
 class DescriptorHPatchesResult:
-    def __init__(self, desc, splt, results_dir='results'):
+    def __init__(self, desc, splt, results_dir='results', index=None):
         self.desc = desc
         self.splt = splt
-        self.verification = DescriptorVerificationResult(desc, splt, results_dir)
-        self.matching = DescriptorMatchingResult(desc, splt, results_dir)
-        self.retrieval = DescriptorRetrievalResult(desc, splt, results_dir)
+        for task, result in task_results.items():
+            row = None
+            if index is not None:
+                row = index.get(desc + "_" + task + "_" + splt['name'])
+            setattr(self, task, result(desc, splt, results_dir,
+                                       summary=row and row['summary']))
+
+
+def update_results_index(results_dir='results'):
+    """Summaries of all the result files in `results_dir`, one per
+    descriptor, task and split, kept in its `index.json`. Only the
+    summaries of the result files that changed since the last update
+    are recomputed."""
+    index_path = os.path.join(results_dir, 'index.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    # the .npz result files take precedence over the legacy .p files
+    files = {}
+    for f in sorted(os.listdir(results_dir)):
+        name, ext = os.path.splitext(f)
+        if ext == '.npz' or (ext == '.p' and name not in files):
+            files[name] = f
+
+    new_index, changed = {}, False
+    for name, f in files.items():
+        parts = name.rsplit("_", 2)
+        if len(parts) != 3 or parts[1] not in task_results:
+            continue
+        desc, task, splt_name = parts
+        st = os.stat(os.path.join(results_dir, f))
+        sig = [f, st.st_size, st.st_mtime_ns]
+        row = index.get(name)
+        if row is None or row['sig'] != sig:
+            res = task_results[task](desc, {'name': splt_name}, results_dir)
+            row = {'desc': desc, 'task': task, 'split': splt_name,
+                   'sig': sig, 'summary': res.summary()}
+            changed = True
+        new_index[name] = row
+
+    if changed or len(new_index) != len(index):
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(new_index, f, indent=1, sort_keys=True)
+        os.replace(index_path + '.tmp', index_path)
+    return new_index
+
+
+def ci_xerr(hpatches_results, task, key):
+    """Error bars of the confidence intervals of a task score, set by
+    `bootstrap.bootstrap_results`, if all the descriptors have one"""
+    results = [getattr(x, task) for x in hpatches_results]
+    cis = [getattr(x, 'ci', {}).get(key) for x in results]
+    if any(ci is None for ci in cis):
+        return None
+    return np.array([[getattr(x, key) - lo, hi - getattr(x, key)]
+                     for x, (lo, hi) in zip(results, cis)]).T
 
 
 def plot_verification(hpatches_results, ax, use_balanced=False, **kwargs):
@@ -128,6 +225,9 @@ def plot_verification(hpatches_results, ax, use_balanced=False, **kwargs):
     ax.barh(
         y_pos,
         avg_verifs,
+        xerr=ci_xerr(hpatches_results, 'verification',
+                     'avg_' + balance_type),
+        error_kw={'capsize': 3},
         color=[desc_info[x].color for x in descrs],
         edgecolor='k',
         linewidth=1.5,
@@ -238,6 +338,8 @@ def plot_matching(hpatches_results, ax, **kwargs):
     ax.barh(
         y_pos,
         avg_verifs,
+        xerr=ci_xerr(hpatches_results, 'matching', 'avg'),
+        error_kw={'capsize': 3},
         color=[desc_info[x].color for x in descrs],
         edgecolor='k',
         linewidth=1.5,
@@ -346,6 +448,8 @@ def plot_retrieval(hpatches_results, ax, **kwargs):
     ax.barh(
         y_pos,
         avg_verifs,
+        xerr=ci_xerr(hpatches_results, 'retrieval', 'avg'),
+        error_kw={'capsize': 3},
         color=[desc_info[x].color for x in descrs],
         edgecolor='k',
         linewidth=1.5,
@@ -1,20 +1,36 @@
 import os.path
+import shutil
+import tempfile
 import time
-from collections import defaultdict
+from functools import lru_cache
 
 # import ray
 import cv2
 import numpy as np
 import pandas as pd
 import utils.metrics as metrics
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 from scipy import spatial
 from tqdm import tqdm
-from utils.hpatch import get_patch
+from utils.distances import (cdist_pairs, chunk_size, hamming_matrix,
+                             l1_matrix, l2_matrix, pair_dists)
+from utils.hpatch import array_hash, descr_hashes, descr_matrix, get_im, tps
 from utils.misc import green
 
 
 PARALLEL_EVALUATION = True
+# number of worker processes of the parallel evaluations, as in joblib
+N_JOBS = -2
+# maximum size in bytes of a block of the retrieval distance matrix
+RETRIEVAL_MEM_BUDGET = 2 ** 30
+# maximum size in bytes of the verification scores kept in memory when they
+# are streamed, see `stream_verif_scores`
+VERIF_MEM_BUDGET = 2 ** 30
+# distance kernels, see `dist_matrix`, and the one used by default by the
+# matching nearest neighbour search and the retrieval distance matrix
+kernels = ['exact', 'blas']
+MATCHING_KERNEL = 'exact'
+RETRIEVAL_KERNEL = 'exact'
 
 id2t = {0: {'e': 'ref', 'h': 'ref', 't': 'ref'},
         1: {'e': 'e1', 'h': 'h1', 't': 't1'},
@@ -33,109 +49,396 @@ def seqs_lengths(seqs):
     """ Helper method to return length for all seqs"""
     N = {}
     for seq in seqs:
-        N[seq] = seqs[seq].N
+        N[seq] = int(seqs[seq].N)
     return N
 
 
-def dist_matrix(D1, D2, distance):
-    """ Distance matrix between two sets of descriptors"""
+def seq_values(s, values):
+    """Values of an array of sequence names, from a dict of values per
+    sequence"""
+    codes, names = pd.factorize(s)
+    return np.array([values[n] for n in names])[codes]
+
+
+def sample_pairs(rng, n):
+    """Two distinct integers in [0, n) for each element of `n`"""
+    i = rng.integers(0, n)
+    j = rng.integers(0, n - 1)
+    return np.stack((i, j + (j >= i)), axis=-1)
+
+
+def patch_stds(seqs, names):
+    """Standard deviation of the reference patches of the sequences, all
+    together in an array, and the offset of each sequence in it"""
+    stds = [np.asarray(get_im(seqs[k], 'ref')).reshape(int(seqs[k].N), -1)
+            .std(axis=1) for k in names]
+    offsets = np.cumsum([0] + [len(std) for std in stds])
+    return np.concatenate(stds), dict(zip(names, offsets[:-1]))
+
+
+def dist_matrix(D1, D2, distance, kernel='exact'):
+    """ Distance matrix between two sets of descriptors
+
+    The `exact` kernel computes it as scipy's cdist, in double precision.
+    The `blas` kernel computes it in single precision, in half the memory,
+    with matrix products for L2 (see `utils.distances.l2_matrix`).
+    """
+    if kernel not in kernels:
+        raise ValueError('Unknown kernel - valid options are |exact|blas|')
     if distance == 'L2':
-        D = spatial.distance.cdist(D1, D2, 'euclidean')
+        if kernel == 'blas':
+            D = l2_matrix(D1, D2)
+        else:
+            D = spatial.distance.cdist(D1, D2, 'euclidean')
     elif distance == 'HAMMING':
-        from utilities import libupmboost_algs
-        # D = spatial.distance.cdist(D1, D2, 'cityblock')
-        # D = spatial.distance.cdist(np.unpackbits(D1, axis=1), np.unpackbits(D2, axis=1), 'hamming')
-        D = libupmboost_algs.cpp_numpy_popcount(np.bitwise_xor(D1[:, np.newaxis], D2[np.newaxis]), 2)
-        D = D.astype(np.float32) / 256.0
+        D = hamming_matrix(D1, D2).astype(np.float32) / 256.0
     elif distance == 'L1':
-        D = spatial.distance.cdist(D1, D2, 'cityblock')
+        if kernel == 'blas':
+            D = l1_matrix(D1, D2)
+        else:
+            D = spatial.distance.cdist(D1, D2, 'cityblock')
     else:
         raise ValueError('Unknown distance - valid options are |L2|L1|HAMMING|')
     return D
 
 
+def result_columns(scores, name, axes):
+    """Columnar results of a task: one column per axis of `scores`, given
+    as (column name, labels) pairs, and a `name` column with the scores,
+    one row per element of `scores` in C order"""
+    grid = np.meshgrid(*[np.asarray(labels) for _, labels in axes],
+                       indexing='ij')
+    res = {k: g.ravel() for (k, _), g in zip(axes, grid)}
+    res[name] = np.asarray(scores, dtype=np.float64).ravel()
+    return res
+
+
+##########################
+# Incremental evaluation #
+##########################
+# The tasks keep in a `cache` dict the intermediate results they can reuse
+# in a later evaluation of the same descriptor (pair distances, APs of
+# the sequences or of the queries), together with the hashes of the
+# descriptors and task files they were computed from. Only what depends
+# on the sequences or task file rows that changed since is recomputed.
+def changed_seqs(descr, cache):
+    """Sequences whose descriptors changed since the evaluation recorded
+    in `cache`, which is updated with the current descriptor hashes"""
+    hashes = descr_hashes(descr)
+    old = {}
+    if 'distance' in cache and str(cache['distance']) == descr['distance']:
+        old = dict(zip(cache['seqs'], cache['hashes']))
+    cache['seqs'] = np.array(list(hashes))
+    cache['hashes'] = np.array(list(hashes.values()))
+    cache['distance'] = np.array(descr['distance'])
+    return set(seq for seq in hashes if old.get(seq) != hashes[seq])
+
+
+##############
+# Task index #
+##############
+# The task files are compiled to a binary index next to them, with the
+# sequences of each row as integer ids into an array of sequence names and
+# the patch types and indices as compact integer arrays, so that the pairs
+# resolve to rows of the stacked descriptor matrices by array indexing.
+# The index is compiled again whenever the .csv files change. The tasks
+# load their files once per process (`load_verif_pairs`,
+# `load_retrieval_task`), and share them between all the descriptors
+# evaluated in it.
+def csv_signature(paths):
+    """Size and modification time of a list of files"""
+    st = [os.stat(p) for p in paths]
+    return np.array([[s.st_size, s.st_mtime_ns] for s in st], dtype=np.int64)
+
+
+def task_index(path, csvs, compile_index):
+    """Loads the compiled index `path` of the .csv task files `csvs`,
+    compiling it with `compile_index` if it is missing or out of date"""
+    sig = csv_signature(csvs)
+    try:
+        with np.load(path) as f:
+            if np.array_equal(f['sig'], sig):
+                return dict((k, f[k]) for k in f.files)
+    except (IOError, ValueError, KeyError):
+        pass
+    index = compile_index(*[pd.read_csv(f).values for f in csvs])
+    index['sig'] = sig
+    try:
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, **index)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        # read-only task folder, the index is only kept in memory
+        pass
+    return index
+
+
+def seq_ids(*columns):
+    """Sorted sequence names of some columns of sequence names, and the
+    ids of the sequences of each column"""
+    names, ids = np.unique(np.concatenate(columns).astype(str),
+                           return_inverse=True)
+    ids = np.split(ids.astype(np.int32),
+                   np.cumsum([len(c) for c in columns])[:-1])
+    return names, ids
+
+
+def compile_verif_pairs(pairs):
+    names, ids = seq_ids(pairs[:, 0], pairs[:, 3])
+    return {'names': names,
+            'seqs': np.stack(ids),
+            'types': np.stack([pairs[:, k].astype(np.int8) for k in (1, 4)]),
+            'idx': np.stack([pairs[:, i].astype(np.int32) for i in (2, 5)])}
+
+
+def compile_retrieval(q, d):
+    names, (q_seq, d_seq) = seq_ids(q[:, 0], d[:, 0])
+    return {'names': names,
+            'q_seq': q_seq, 'q_idx': q[:, 1].astype(np.int32),
+            'd_seq': d_seq, 'd_idx': d[:, 1].astype(np.int32)}
+
+
+def seq_rows(descr, names, seqs, idx):
+    """Rows of the stacked descriptor matrices of patches given by the ids
+    of their sequences into `names` and their indices"""
+    offsets = descr_matrix(descr, 'ref')[1]
+    missing = [n for n in names if n not in offsets]
+    assert not missing, "The descriptors of %s were not loaded, see the " \
+        "`seqs` of `load_descrs`." % ', '.join(missing)
+    seq_offsets = np.array([offsets[n] for n in names], dtype=np.int64)
+    return seq_offsets[seqs] + idx
+
+
 #####################
 # Verification task #
 #####################
-def get_verif_dists(descr, pairs, op):
+@lru_cache(maxsize=None)
+def load_verif_pairs(f):
+    """Loads the compiled index of a verification task file
+
+    Returns the pairs as indexed in the task index, with their number and
+    the hashes of their chunks.
+    """
+    pairs = task_index(os.path.join(tskdir, f + '.npz'),
+                       [os.path.join(tskdir, f + '.csv')], compile_verif_pairs)
+    pairs['n'] = pairs['seqs'].shape[1]
+    pairs['blocks'] = np.array([
+        array_hash([pairs['names']] + [pairs[k][:, b:b + chunk_size]
+                                       for k in ('seqs', 'types', 'idx')])
+        for b in range(0, pairs['n'], chunk_size)])
+    return pairs
+
+
+def get_verif_dists(descr, pairs, op, cache=None, changed=(), name=''):
+    """Distances of the verification pairs for each noise level
+
+    The pairs, as loaded by `load_verif_pairs`, are resolved to rows of
+    the stacked descriptor matrices, and the distances are then computed
+    in chunks of pairs. The chunks that are unchanged since the
+    evaluation recorded in `cache`, and have no pairs from the `changed`
+    sequences, reuse the distances kept there under `name`.
+    """
+    if cache is None:
+        cache = {}
     d = {}
-    for t in ['e', 'h', 't']:
-        d[t] = np.empty((pairs.shape[0], 1))
-    idx = 0
-    pbar = tqdm(pairs)
+    for t in tp:
+        d[t] = np.empty((pairs['n'], 1))
+    old_blocks = cache.get(name + '_blocks', [])
+    m = np.isin(pairs['names'], list(changed))
+    touched = m[pairs['seqs'][0]] | m[pairs['seqs'][1]]
+    rows = [seq_rows(descr, pairs['names'], pairs['seqs'][j], pairs['idx'][j])
+            for j in range(2)]
+    types = pairs['types']
+
+    pbar = tqdm(range(0, pairs['n'], chunk_size))
     pbar.set_description("Processing verification task %i/3 " % op)
-
-    # TODO Use BFMatcher to calculate this distance
-    for p in pbar:
-        [t1, t2] = [id2t[p[1]], id2t[p[4]]]
+    for b, start in enumerate(pbar):
+        c = slice(start, start + chunk_size)
+        if b < len(old_blocks) and old_blocks[b] == pairs['blocks'][b] and \
+                not touched[c].any():
+            for j, t in enumerate(tp):
+                d[t][c, 0] = cache[name + '_dists'][c, j]
+            continue
         for t in tp:
-            d1 = getattr(descr[p[0]], t1[t])[p[2]]
-            d2 = getattr(descr[p[3]], t2[t])[p[5]]
-            distance = descr['distance']
-            if distance == 'L2':
-                dist = spatial.distance.euclidean(d1, d2)
-            elif distance == 'HAMMING':
-                # dist = spatial.distance.cityblock(d1, d2)
-                # dist = np.unpackbits(np.bitwise_xor(d1, d2)).sum()
-                from utilities import libupmboost_algs
-                dist = libupmboost_algs.cpp_numpy_popcount(np.bitwise_xor(d1, d2))
-            elif distance == 'L1':
-                dist = spatial.distance.cityblock(d1, d2)
-            else:
-                raise ValueError('Unknown distance - valid options are |L2|L1|HAMMING|')
-            d[t][idx] = dist
-        idx += 1
+            d[t][c, 0] = chunk_dists(descr, [r[c] for r in rows],
+                                     types[:, c], t)
+    cache[name + '_blocks'] = pairs['blocks']
+    # the distances of single precision or binary descriptors are kept in
+    # single precision, which halves the cache without changing them
+    dists = np.hstack([d[t] for t in tp])
+    dists32 = dists.astype(np.float32)
+    cache[name + '_dists'] = dists32 if np.array_equal(dists32, dists) \
+        else dists
     return d
 
 
-def eval_verification(descr, split):
-    print('>> Evaluating %s task' % green('verification'))
-
-    start = time.time()
-    pos = pd.read_csv(os.path.join(tskdir, 'verif_pos_split-' + split['name'] + '.csv')).values
-    neg_intra = pd.read_csv(os.path.join(tskdir, 'verif_neg_intra_split-' + split['name'] + '.csv')).values
-    neg_inter = pd.read_csv(os.path.join(tskdir, 'verif_neg_inter_split-' + split['name'] + '.csv')).values
-
-    d_pos = get_verif_dists(descr, pos, 1)
-    d_neg_intra = get_verif_dists(descr, neg_intra, 2)
-    d_neg_inter = get_verif_dists(descr, neg_inter, 3)
+def iter_verif_dists(descr, pairs, op):
+    """Distances of the verification pairs for each noise level, computed
+    and yielded by chunks of pairs, as (start, {noise: distances}), without
+    keeping them"""
+    pbar = tqdm(range(0, pairs['n'], chunk_size))
+    pbar.set_description("Processing verification task %i/3 " % op)
+    for start in pbar:
+        c = slice(start, start + chunk_size)
+        rows = [seq_rows(descr, pairs['names'], pairs['seqs'][j][c],
+                         pairs['idx'][j][c]) for j in range(2)]
+        yield start, dict((t, chunk_dists(descr, rows, pairs['types'][:, c],
+                                          t)) for t in tp)
+
+
+def chunk_dists(descr, rows, types, t):
+    """Distances of a chunk of pairs, given by the rows and type ids of
+    both of their patches, for noise level t"""
+    d1, d2 = [gather_descrs(descr, rows[j], types[j], t) for j in range(2)]
+    return pair_dists(d1, d2, descr['distance'])
+
+
+def gather_descrs(descr, rows, types, t):
+    """Gathers the descriptors at the given rows of the stacked matrices,
+    with patch type given by the type ids of the task files"""
+    D = None
+    for k in np.unique(types):
+        m = types == k
+        D_k = descr_matrix(descr, id2t[k][t])[0]
+        if D is None:
+            D = np.empty((rows.shape[0], D_k.shape[1]), dtype=D_k.dtype)
+        D[m] = D_k[rows[m]]
+    return D
 
-    results = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
 
-    for t in tp:
-        l = np.vstack((np.zeros_like(d_pos[t]), np.ones_like(d_pos[t])))
-        d_intra = np.vstack((d_neg_intra[t], d_pos[t]))
-        d_inter = np.vstack((d_neg_inter[t], d_pos[t]))
+def eval_verification(descr, split, cache=None, stream=False,
+                      mem_budget=None):
+    """Evaluates the verification task
 
-        # get results for the balanced protocol: 1M Positives - 1M Negatives
-        _, _, auc = metrics.roc(-d_intra, l)
-        results[t]['intra']['balanced']['auc'] = auc
-        results[t]['inter']['balanced']['auc'] = auc
-
-        # get results for the imbalanced protocol: 0.2M Pos - 1M Negs
-        N_imb = d_pos[t].shape[0] + int(d_pos[t].shape[0] * 0.2)  # 1M + 0.2*1M
-        _, _, ap = metrics.pr(-d_intra[0:N_imb], l[0:N_imb])
-        results[t]['intra']['imbalanced']['ap'] = ap
+    Distances of the pairs are reused from `cache` where possible, and
+    the new ones are recorded there. With `stream`, the distances are
+    scored as they are computed, in `mem_budget` bytes, and neither
+    reused nor recorded, for task files too large to keep them.
+    """
+    print('>> Evaluating %s task' % green('verification'))
 
-        _, _, ap = metrics.pr(-d_inter[0:N_imb], l[0:N_imb])
-        results[t]['inter']['imbalanced']['ap'] = ap
+    start = time.time()
+    if cache is None:
+        cache = {}
+    changed = changed_seqs(descr, cache)
+    pos = load_verif_pairs('verif_pos_split-' + split['name'])
+    neg_intra = load_verif_pairs('verif_neg_intra_split-' + split['name'])
+    neg_inter = load_verif_pairs('verif_neg_inter_split-' + split['name'])
+
+    if stream:
+        # the distances recorded before are not updated any more
+        for k in list(cache):
+            if k.startswith(('pos_', 'neg_intra_', 'neg_inter_')):
+                del cache[k]
+        scores = stream_verif_scores(
+            iter_verif_dists(descr, pos, 1),
+            iter_verif_dists(descr, neg_intra, 2),
+            iter_verif_dists(descr, neg_inter, 3),
+            pos['n'], neg_intra['n'], neg_inter['n'],
+            mem_budget or VERIF_MEM_BUDGET)
+    else:
+        d_pos = get_verif_dists(descr, pos, 1, cache, changed, 'pos')
+        d_neg_intra = get_verif_dists(descr, neg_intra, 2, cache, changed,
+                                      'neg_intra')
+        d_neg_inter = get_verif_dists(descr, neg_inter, 3, cache, changed,
+                                      'neg_inter')
+        scores = verif_scores(d_pos, d_neg_intra, d_neg_inter)
     end = time.time()
     print(">> %s task finished in %.0f secs  " % (green('Verification'),
                                                   end - start))
-    return results
+    return result_columns(scores, 'score',
+                          [('noise', tp), ('negs', ['intra', 'inter']),
+                           ('balance', ['balanced', 'imbalanced'])])
+
+
+def verif_scores(d_pos, d_neg_intra, d_neg_inter):
+    """Balanced AUCs and imbalanced APs of the verification task, by noise
+    level and negatives, from the distances of the pairs by noise level"""
+    # balanced AUCs and imbalanced APs per noise level and negatives, from
+    # the distances of the positives and of each negatives sorted once
+    scores = np.empty((len(tp), 2, 2))
+    for j, t in enumerate(tp):
+        r_pos = metrics.ranking(-d_pos[t], 1)
+        r_intra = metrics.merge_rankings(
+            metrics.ranking(-d_neg_intra[t], 0), r_pos)
+        r_inter = metrics.merge_rankings(
+            metrics.ranking(-d_neg_inter[t], 0), r_pos)
 
+        # get results for the balanced protocol: 1M Positives - 1M Negatives
+        scores[j, :, 0] = r_intra.auc()
 
-def gen_verif(seqs, split, N_pos=1e6, N_neg=1e6):
-    np.random.seed(42)
+        # get results for the imbalanced protocol: 0.2M Pos - 1M Negs
+        N_imb = d_pos[t].shape[0] + int(d_pos[t].shape[0] * 0.2)  # 1M + 0.2*1M
+        scores[j, 0, 1] = r_intra.prefix(N_imb).ap()
+        scores[j, 1, 1] = r_inter.prefix(N_imb).ap()
+    return scores
+
+
+def stream_verif_scores(pos, neg_intra, neg_inter, n_pos, n_intra, n_inter,
+                        mem_budget=VERIF_MEM_BUDGET):
+    """Scores of `verif_scores`, from the distances of the pairs yielded
+    by chunks, as by `iter_verif_dists`, for each of the 3 task files
+
+    The chunks are fed to a `metrics.sorted_runs` for each score, which
+    are given an equal share of `mem_budget` bytes, and write the sorted
+    scores beyond it to temporary files.
+    """
+    N_imb = n_pos + int(n_pos * 0.2)
+    runs = dict(((t, k), metrics.sorted_runs(mem_budget / 9.0))
+                for t in tp for k in ('auc', 'intra', 'inter'))
+    # the runs fed with the chunks of each task file, and the pairs of the
+    # file they take, as for the prefixes of `verif_scores`
+    feeds = [(neg_intra, 0, [('auc', n_intra), ('intra', N_imb)]),
+             (neg_inter, 0, [('inter', N_imb)]),
+             (pos, 1, [('auc', n_pos), ('intra', N_imb - n_intra),
+                       ('inter', N_imb - n_inter)])]
+    try:
+        for chunks, label, keys in feeds:
+            for start, d in chunks:
+                for t in tp:
+                    for k, stop in keys:
+                        s = -d[t][:max(0, stop - start)]
+                        if len(s):
+                            runs[t, k].add(s, label)
+        scores = np.empty((len(tp), 2, 2))
+        for j, t in enumerate(tp):
+            scores[j, :, 0] = runs[t, 'auc'].auc()
+            scores[j, 0, 1] = runs[t, 'intra'].ap()
+            scores[j, 1, 1] = runs[t, 'inter'].ap()
+    finally:
+        for r in runs.values():
+            r.close()
+    return scores
+
+
+def gen_verif(seqs, split, N_pos=1e6, N_neg=1e6, compat=False, seed=42):
+    """Generates the verification task files of a split
+
+    The pairs are sampled in batches with a numpy Generator. With `compat`
+    they are sampled row by row with the global RandomState instead, as
+    the task files of the benchmark were generated (with seed 42).
+    """
+    seq2len = seqs_lengths(seqs)
+    if compat:
+        np.random.seed(seed)
+        s = np.random.choice(split['test'], int(N_pos))
+        # np.random.choice(np.arange(k), 2, replace=False) shuffles the
+        # whole range, which cannot be batched without changing the draws
+        s_idx = np.array(
+            [np.random.permutation(k)[:2] for k in seq_values(s, seq2len)])
+        s_type = np.array([np.random.permutation(5)[:2] for k in s_idx])
+        s_inter = np.random.choice(split['test'], int(N_neg))
+        # same draws as np.random.randint(k) for each row
+        s_idx_inter = np.random.randint(seq_values(s_inter, seq2len))
+    else:
+        rng = np.random.default_rng(seed)
+        s = rng.choice(split['test'], int(N_pos))
+        s_idx = sample_pairs(rng, seq_values(s, seq2len))
+        s_type = sample_pairs(rng, np.full(s.shape[0], 5))
+        s_inter = rng.choice(split['test'], int(N_neg))
+        s_idx_inter = rng.integers(0, seq_values(s_inter, seq2len))
 
     # positives
-    s = np.random.choice(split['test'], int(N_pos))
-    seq2len = seqs_lengths(seqs)
-    s_N = [seq2len[k] for k in s]
-    s_idx = np.array(
-        [np.random.choice(np.arange(k), 2, replace=False) for k in s_N])
-    s_type = np.array(
-        [np.random.choice(np.arange(5), 2, replace=False) for k in s_idx])
     df = pd.DataFrame({'s1': pd.Series(s, dtype=object),
                        's2': pd.Series(s, dtype=object),
                        'idx1': pd.Series(s_idx[:, 0], dtype=int),
@@ -163,9 +466,6 @@ def gen_verif(seqs, split, N_pos=1e6, N_neg=1e6):
         index=False)
 
     # inter-sequence negatives
-    s_inter = np.random.choice(split['test'], int(N_neg))
-    s_N_inter = [seq2len[k] for k in s_inter]
-    s_idx_inter = np.array([np.random.randint(k) for k in s_N_inter])
     df = pd.DataFrame({'s1': pd.Series(s, dtype=object),
                        's2': pd.Series(s_inter, dtype=object),
                        'idx1': pd.Series(s_idx[:, 0], dtype=int),
@@ -183,150 +483,298 @@ def gen_verif(seqs, split, N_pos=1e6, N_neg=1e6):
 #################
 # Matching task #
 #################
-def eval_matching(descr, split):
-    print('>> Evaluating %s task' % green('matching'))
-    start = time.time()
+norms = {'L2': cv2.NORM_L2, 'L1': cv2.NORM_L1, 'HAMMING': cv2.NORM_HAMMING}
 
-    binary = descr['distance'] == 'HAMMING'
 
-    if descr['distance'] == 'L2':
-        bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
-    elif descr['distance'] == 'HAMMING':
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
-    elif descr['distance'] == 'L1':
-        bf = cv2.BFMatcher(cv2.NORM_L1, crossCheck=False)
-    else:
+def get_matching_ap(d_ref, d, distance, kernel=MATCHING_KERNEL):
+    """AP of matching each reference descriptor to its nearest neighbour
+
+    The nearest neighbours are found with cv2.batchDistance, the routine
+    behind BFMatcher.match, which returns them as arrays instead of DMatch
+    objects. Ties are sorted as the stable sort of the matches did. With
+    the `blas` kernel, they are found in the distance matrix of
+    `dist_matrix` instead, which is faster for long descriptors.
+    """
+    if distance not in norms:
         raise ValueError('Unknown distance - valid options are |L2|L1|HAMMING|')
+    if distance != 'HAMMING':
+        d_ref = d_ref.astype(np.float32)
+        d = d.astype(np.float32)
+    if kernel == 'blas' and distance != 'HAMMING':
+        D = dist_matrix(d_ref, d, distance, kernel)
+        nidx = D.argmin(axis=1)
+        dist = D[np.arange(D.shape[0]), nidx]
+    else:
+        dtype = cv2.CV_32S if distance == 'HAMMING' else cv2.CV_32F
+        dist, nidx = cv2.batchDistance(d_ref, d, dtype,
+                                       normType=norms[distance], K=1)
+        dist, nidx = dist[:, 0], nidx[:, 0]
+    order = np.argsort(dist, kind='mergesort')
+    m_l = nidx[order] == order
 
-    results = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
-    pbar = tqdm(split['test'])
     small = 1e-10
-    for seq in pbar:
-        d_ref = getattr(descr[seq], 'ref')
-        if not binary:
-            d_ref = d_ref.astype(np.float32)
-        correspondences = np.maximum(d_ref.shape[0], small)
-        n_patches_at_ptn = np.maximum(np.arange(correspondences + 1), small)
-        for t in tp:
-            for i in range(1, 6):
-                d = getattr(descr[seq], t + str(i))
-                if not binary:
-                    d = d.astype(np.float32)
-
-                matches1 = bf.match(d_ref, d)
-                matches1.sort(key=lambda m: m.distance)
-                m_l = np.array(list(map(lambda m: m.trainIdx == m.queryIdx, matches1)))
-                my_tp = np.append(0, np.cumsum(m_l))
-                # compute precision and recall
-                recall = my_tp / correspondences
-                precision = np.maximum(my_tp, small) / n_patches_at_ptn
-                # Calculate the average precision using trapezoidal area
-                ap = np.trapz(precision, recall)
-                # An approximation: np.sum(precision[1:][m_l] / correspondences)
-                results[seq][t][i]['ap'] = ap
+    correspondences = np.maximum(d_ref.shape[0], small)
+    n_patches_at_ptn = np.maximum(np.arange(m_l.shape[0] + 1), small)
+    my_tp = np.append(0, np.cumsum(m_l))
+    # compute precision and recall
+    recall = my_tp / correspondences
+    precision = np.maximum(my_tp, small) / n_patches_at_ptn
+    # Calculate the average precision using trapezoidal area
+    # An approximation: np.sum(precision[1:][m_l] / correspondences)
+    return np.trapz(precision, recall)
+
+
+def eval_matching_seq(descs, distance, kernel=MATCHING_KERNEL):
+    """Matching APs of a sequence, as an array of shape (noise levels, 5),
+    from its descriptors listed in the order of `utils.hpatch.tps`"""
+    d_ref = descs[0]
+    ap = np.empty((len(tp), 5))
+    for j in range(len(tp)):
+        for i in range(1, 6):
+            ap[j, i - 1] = get_matching_ap(d_ref, descs[5 * j + i], distance,
+                                           kernel)
+    return ap
+
+
+def eval_matching(descr, split, n_jobs=None, cache=None, kernel=None):
+    """Evaluates the matching task
+
+    Sequences are evaluated independently by `n_jobs` worker processes
+    (N_JOBS by default), with the nearest neighbour search of `kernel`
+    (MATCHING_KERNEL by default). The APs of the sequences that did not
+    change since the evaluation recorded in `cache` are reused.
+    """
+    print('>> Evaluating %s task' % green('matching'))
+    start = time.time()
+    if n_jobs is None:
+        n_jobs = N_JOBS if PARALLEL_EVALUATION else 1
+    if kernel is None:
+        kernel = MATCHING_KERNEL
+    if cache is None:
+        cache = {}
+    changed = changed_seqs(descr, cache)
+    seq_aps = {}
+    # caches of older versions were all computed with the exact kernel
+    if str(cache.get('kernel', 'exact')) == kernel:
+        seq_aps = dict(zip(cache.get('ap_seqs', []), cache.get('ap', [])))
+    todo = [seq for seq in split['test']
+            if seq in changed or seq not in seq_aps]
+
+    pbar = tqdm(todo)
+    aps = Parallel(n_jobs=n_jobs)(
+        delayed(eval_matching_seq)([getattr(descr[seq], t) for t in tps],
+                                   descr['distance'], kernel)
+        for seq in pbar)
+    seq_aps.update(zip(todo, aps))
+    aps = np.array([seq_aps[seq] for seq in split['test']])
+    cache['ap_seqs'] = np.array(split['test'])
+    cache['ap'] = aps
+    cache['kernel'] = np.array(kernel)
 
     end = time.time()
     print(">> %s task finished in %.0f secs  " % (green('Matching'), end - start))
-    return results
+    return result_columns(aps, 'ap', [('seq', split['test']), ('noise', tp),
+                                      ('idx', np.arange(1, 6))])
 
 
 ##################
 # Retrieval task #
 ##################
 
-def get_query_intra_dists(descr, d, query, t):
-    idx = query[1]
-    seq = query[0]
-    D = np.empty(5)
-    d = np.expand_dims(d, axis=0)
-
-    for i in range(1, 6):
-        d_ = getattr(descr[seq], t + str(i))[idx]
-        d_ = np.expand_dims(d_, axis=0)
-        D[i - 1] = dist_matrix(d, d_, descr['distance'])[0]
+def get_intra_dists(desc_q, desc_pos, distance):
+    """Distances between each query and its 5 positives for every noise
+    level, as an array of shape (queries, noise levels, 5)"""
+    D = np.empty(desc_pos.shape[0:3])
+    for j in range(len(tp)):
+        D[:, j] = cdist_pairs(np.repeat(desc_q, 5, axis=0),
+                              desc_pos[:, j].reshape(-1, desc_q.shape[1]),
+                              distance).reshape(-1, 5)
     return D
 
 
-def eval_retrieval(descr, split):
+def shared_array(a, folder):
+    """Copies an array to a memory-mapped file in `folder`, so that worker
+    processes can read it without copies"""
+    path = os.path.join(folder, '%i.npy' % len(os.listdir(folder)))
+    mm = np.lib.format.open_memmap(path, mode='w+', dtype=a.dtype,
+                                   shape=a.shape)
+    mm[:] = a
+    mm.flush()
+    del mm
+    return np.load(path, mmap_mode='r')
+
+
+def eval_retrieval_block(c, q_seq, d_seq, desc_q, desc_d, D_intra,
+                         distance, at_ranks, kernel=RETRIEVAL_KERNEL):
+    """Retrieval APs of the block `c` of queries, as an array of shape
+    (queries, noise levels, pool sizes)"""
+    q_seq, desc_q, D_intra = q_seq[c], desc_q[c], D_intra[c]
+    D = dist_matrix(desc_q, desc_d, distance, kernel)
+
+    # scores of the 5 positives followed by the masked distractors of
+    # each query, keeping only the distractors that fit in the largest
+    # pool, padded with never retrieved entries
+    n_keep = max(at_ranks) - 5
+    S = np.full((D.shape[0], 5 + n_keep), -np.inf)
+    for seq in np.unique(q_seq):
+        r = np.where(q_seq == seq)[0]
+        m = np.where(d_seq != seq)[0][:n_keep]
+        S[r, 5:5 + len(m)] = -D[r][:, m]
+    del D
+    gt = np.zeros(S.shape[1])
+    gt[0:5] = 1
+    ap = np.empty((desc_q.shape[0], len(tp), len(at_ranks)))
+    for j, t in enumerate(tp):
+        S[:, 0:5] = -D_intra[:, j]
+        ap[:, j] = metrics.pr_at_ranks(S, gt, at_ranks)
+    return ap
+
+
+def retrieval_index(name):
+    """Compiled index of the queries and distractors of a retrieval split"""
+    return task_index(
+        os.path.join(tskdir, 'retr_split-' + name + '.npz'),
+        [os.path.join(tskdir, 'retr_' + f + '_split-' + name + '.csv')
+         for f in ('queries', 'distractors')], compile_retrieval)
+
+
+@lru_cache(maxsize=None)
+def load_retrieval_task(name, seqs, max_rank):
+    """Loads the compiled index of the queries and distractors of a
+    retrieval split
+
+    Only the distractors that fit in the largest pool (of `max_rank`
+    entries) of a query of any of the `seqs` are kept, together with its 5
+    positives. The task is returned with its hash.
+    """
+    task = retrieval_index(name)
+    ids = dict((n, i) for i, n in enumerate(task['names']))
+    n_d = 0
+    for seq in seqs:
+        m = np.where(task['d_seq'] != ids.get(seq, -1))[0][:max_rank - 5]
+        n_d = max(n_d, m[-1] + 1 if m.size else 0)
+    task['d_seq'], task['d_idx'] = task['d_seq'][:n_d], task['d_idx'][:n_d]
+    task['hash'] = array_hash([task[k] for k in
+                               ('names', 'q_seq', 'q_idx', 'd_seq', 'd_idx')])
+    return task
+
+
+def eval_retrieval(descr, split, mem_budget=None, n_jobs=None, cache=None,
+                   kernel=None):
+    """Evaluates the retrieval task
+
+    The queries are split in blocks that are evaluated by `n_jobs` worker
+    processes (N_JOBS by default), which read the descriptors from shared
+    memory. Blocks are sized so that, all workers together, never take
+    more than `mem_budget` bytes (RETRIEVAL_MEM_BUDGET by default). Their
+    distance matrices are computed by `kernel` (RETRIEVAL_KERNEL by
+    default).
+
+    The APs recorded in `cache` are reused when the task files did not
+    change, except for the queries of the sequences that changed. All the
+    queries are evaluated again if any of the distractors changed.
+    """
     print('>> Evaluating %s task' % green('retrieval'))
     start = time.time()
+    if mem_budget is None:
+        mem_budget = RETRIEVAL_MEM_BUDGET
+    if n_jobs is None:
+        n_jobs = N_JOBS if PARALLEL_EVALUATION else 1
+    if kernel is None:
+        kernel = RETRIEVAL_KERNEL
 
-    q = pd.read_csv(os.path.join(tskdir, 'retr_queries_split-' + split['name'] + '.csv')).values
-    d = pd.read_csv(os.path.join(tskdir, 'retr_distractors_split-' + split['name'] + '.csv')).values
-
-    desc_q = np.array([descr[scene_name].ref[kp_idx] for scene_name, kp_idx in q])
-    desc_d = np.array([descr[scene_name].ref[kp_idx] for scene_name, kp_idx in d])
-
-    # distractor masking per sequence
-    m = dict((seq, d[:, 0] != seq) for seq in split['test'])
-
-    print(">> Please wait, computing distance matrix...")
-    D = dist_matrix(desc_q, desc_d, descr['distance'])
-    print(">> Distance matrix done.")
-
-    results = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
     # at_ranks = [int(x*N_distractors) for x in [0.25,0.5,0.75,1]]
     at_ranks = [100, 500, 1000, 5000, 10000, 15000, 20000]
-
-    pbar = tqdm(range(desc_q.shape[0]))
-    pbar.set_description("Processing retrieval task")
-
-    def eval_retrieval_seq(i):
-        for t in tp:
-            D_intra = get_query_intra_dists(descr, desc_q[i], q[i], t)
-            D_ = D[i, :]
-            D_ = D_[m[q[i][0]]]
-            gt = np.zeros_like(D_)
-            D_ = np.hstack((D_intra, D_))
-            gt = np.hstack((np.array([1, 1, 1, 1, 1]), gt))
-            for k in at_ranks:
-                _, _, ap = metrics.pr(-D_[0:k], gt[0:k])
-                results[i][t][k]['ap'] = ap
-
-    if PARALLEL_EVALUATION:
-        # Call the function train_ith_wl_in_parallel using all the CPUs but one
-        Parallel(n_jobs=-2,
-                 backend='threading',
-                 require='sharedmem',
-                 prefer='threads')(delayed(eval_retrieval_seq)(i) for i in pbar)
+    task = load_retrieval_task(split['name'], tuple(split['test']),
+                               max(at_ranks))
+    n_d = task['d_seq'].shape[0]
+
+    if cache is None:
+        cache = {}
+    m = np.isin(task['names'], list(changed_seqs(descr, cache)))
+    n_q = task['q_seq'].shape[0]
+    if 'ap' in cache and str(cache['tasks']) == task['hash'] and \
+            str(cache.get('kernel', 'exact')) == kernel and \
+            not m[task['d_seq']].any():
+        ap = cache['ap']
+        todo = np.where(m[task['q_seq']])[0]
     else:
-        list(map(eval_retrieval_seq, pbar))
+        ap = np.empty((n_q, len(tp), len(at_ranks)))
+        todo = np.arange(n_q)
+    q_seq = task['q_seq'][todo]
+
+    # query, distractor and positive descriptors, gathered from the
+    # stacked descriptor matrices
+    q_rows = seq_rows(descr, task['names'], q_seq, task['q_idx'][todo])
+    d_rows = seq_rows(descr, task['names'], task['d_seq'], task['d_idx'])
+    desc_q = descr_matrix(descr, 'ref')[0][q_rows]
+    desc_d = descr_matrix(descr, 'ref')[0][d_rows]
+    desc_pos = np.stack([np.stack([descr_matrix(descr, t + str(i))[0][q_rows]
+                                   for i in range(1, 6)], axis=1)
+                         for t in tp], axis=1)
+    D_intra = get_intra_dists(desc_q, desc_pos, descr['distance'])
+    del desc_pos
+
+    # scoring a block takes about 16 arrays the size of its distance matrix
+    n_workers = effective_n_jobs(n_jobs)
+    n_block = max(1, int(mem_budget // (16 * 8 * n_d * n_workers)))
+    n_block = min(n_block, max(1, -(-len(todo) // n_workers)))
+    blocks = [slice(b, b + n_block) for b in range(0, len(todo), n_block)]
+
+    shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    folder = tempfile.mkdtemp(prefix='hpatches_', dir=shm)
+    try:
+        args = [shared_array(a, folder) for a in
+                [q_seq, task['d_seq'], desc_q, desc_d, D_intra]]
+        pbar = tqdm(blocks)
+        pbar.set_description("Processing retrieval task")
+        aps = Parallel(n_jobs=n_jobs)(
+            delayed(eval_retrieval_block)(c, *args, distance=descr['distance'],
+                                          at_ranks=at_ranks, kernel=kernel)
+            for c in pbar)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    if aps:
+        ap[todo] = np.concatenate(aps)
+    cache['tasks'] = np.array(task['hash'])
+    cache['kernel'] = np.array(kernel)
+    cache['ap'] = ap
     end = time.time()
     print(">> %s task finished in %.0f secs  " % (green('Retrieval'), end - start))
-    return results
-
-
-def gen_retrieval(seqs, split, N_queries=0.5 * 1e4, N_distractors=2 * 1e4):
-    np.random.seed(42)
-    seq2len = seqs_lengths(seqs)
-
-    s_q = np.random.choice(split['test'], int(N_queries * 4))
-    s_q_N = [seq2len[k] for k in s_q]
-    s_q_idx = [np.random.randint(k) for k in s_q_N]
-    s_q_idx = np.array(s_q_idx)
+    return result_columns(ap, 'ap', [('query', np.arange(n_q)),
+                                     ('noise', tp), ('pool', at_ranks)])
 
-    s_d = np.random.choice(split['test'], int(N_distractors * 10))
-    s_d_N = [seq2len[k] for k in s_d]
-    s_d_idx = [np.random.randint(k) for k in s_d_N]
-    s_d_idx = np.array(s_d_idx)
 
-    msk = np.zeros((s_q.shape[0],))
-    for i in range(s_q.shape[0]):
-        p = get_patch(seqs[s_q[i]], 'ref', s_q_idx[i])
-        if np.std(p) > 10:
-            msk[i] = 1
+def gen_retrieval(seqs, split, N_queries=0.5 * 1e4, N_distractors=2 * 1e4,
+                  compat=False, seed=42):
+    """Generates the retrieval task files of a split
 
-    msk = np.where(msk == 1)
+    The patches are sampled in batches with a numpy Generator. With
+    `compat` the global RandomState is used instead, as the task files of
+    the benchmark were generated (with seed 42).
+    """
+    seq2len = seqs_lengths(seqs)
+    if compat:
+        np.random.seed(seed)
+        s_q = np.random.choice(split['test'], int(N_queries * 4))
+        # same draws as np.random.randint(k) for each row
+        s_q_idx = np.random.randint(seq_values(s_q, seq2len))
+        s_d = np.random.choice(split['test'], int(N_distractors * 10))
+        s_d_idx = np.random.randint(seq_values(s_d, seq2len))
+    else:
+        rng = np.random.default_rng(seed)
+        s_q = rng.choice(split['test'], int(N_queries * 4))
+        s_q_idx = rng.integers(0, seq_values(s_q, seq2len))
+        s_d = rng.choice(split['test'], int(N_distractors * 10))
+        s_d_idx = rng.integers(0, seq_values(s_d, seq2len))
+
+    # keep only the patches with some texture
+    stds, offsets = patch_stds(seqs, split['test'])
+    msk = np.where(stds[seq_values(s_q, offsets) + s_q_idx] > 10)
     s_q = s_q[msk]
     s_q_idx = s_q_idx[msk]
 
-    msk = np.zeros((s_d.shape[0],))
-    for i in range(s_d.shape[0]):
-        p = get_patch(seqs[s_d[i]], 'ref', s_d_idx[i])
-        if np.std(p) > 10:
-            msk[i] = 1
-
-    msk = np.where(msk == 1)
+    msk = np.where(stds[seq_values(s_d, offsets) + s_d_idx] > 10)
     s_d = s_d[msk]
     s_d_idx = s_d_idx[msk]
     q_ = np.stack((s_q, s_q_idx), axis=-1)
@@ -342,13 +790,13 @@ def gen_retrieval(seqs, split, N_queries=0.5 * 1e4, N_distractors=2 * 1e4):
 
     df_q = df_q.drop_duplicates()
     df_d = df_d.drop_duplicates()
-    df_q = df_q.head(N_queries)
+    df_q = df_q.head(int(N_queries))
     df_q_ = df_q.copy()
 
     df_q_.set_index(['s', 'idx'], inplace=True)
     df_d.set_index(['s', 'idx'], inplace=True)
     df_d = df_d[~df_d.index.isin(df_q_.index)].reset_index()
-    df_d = df_d.head(N_distractors)
+    df_d = df_d.head(int(N_distractors))
 
     df_q.to_csv(
         os.path.join(tskdir, 'retr_queries_split-' + split['name'] + '.csv'),
@@ -362,3 +810,19 @@ def gen_retrieval(seqs, split, N_queries=0.5 * 1e4, N_distractors=2 * 1e4):
 methods = {'verification': eval_verification,
            'matching': eval_matching,
            'retrieval': eval_retrieval}
+
+
+def task_seqs(splits, tasks):
+    """Sequences whose descriptors the tasks read on the splits, as found
+    in their task files"""
+    seqs = set()
+    for split in splits:
+        if 'verification' in tasks:
+            for f in ('verif_pos', 'verif_neg_intra', 'verif_neg_inter'):
+                seqs.update(load_verif_pairs(
+                    f + '_split-' + split['name'])['names'])
+        if 'matching' in tasks:
+            seqs.update(split['test'])
+        if 'retrieval' in tasks:
+            seqs.update(retrieval_index(split['name'])['names'])
+    return seqs